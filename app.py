@@ -1,11 +1,11 @@
 from __future__ import print_function
 # TODO: Make everything secure
-from io import BytesIO
 
 # app.py
 
 from flask import Flask, render_template, request, redirect, url_for, flash, send_file, session, abort, \
-    send_from_directory
+    Response, stream_with_context
+import click
 from flask_login import (
     LoginManager, login_user, logout_user, login_required, current_user
 )
@@ -15,11 +15,19 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
 from werkzeug.datastructures import MultiDict
+from werkzeug.http import is_resource_modified
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
 from itertools import groupby
+import threading
+from cachetools import LRUCache
 import os
 from werkzeug.utils import secure_filename
 
+import glob
 import json
+import zlib
+from datetime import datetime
 import requests  # Add this import if not already present
 
 import base64
@@ -35,26 +43,52 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
-from models import db, User, Story, Unit
-from openai_client import call_openai
+from models import db, User, Story, Unit, UnitReference, Job, NAME_MAX_LENGTH, normalize_name, rebuild_unit_references
+from openai_client import LLMError, LLMBusyError
+from structured_output import call_openai_json
+from llm_cache import llm_cache
+from llm_metrics import llm_metrics
+from rate_limit import llm_limiter
+from jobs import init_jobs, submit_job, job_handler, fail_lost_job
+from context_selection import referenced_names, select_context
+from speculation import SPECULATIVE_PREFILL, speculations
+from storage import init_storage
+from migrations import upgrade
+from unit_schema import UNIT_CLASSES, UNIT_SCHEMAS
 
 
 
 
+# story id -> (revision, unit names, undefined names), see story_names
+story_names_cache = LRUCache(maxsize=int(os.environ.get('STORY_NAMES_CACHE_SIZE', 256)))
+story_names_lock = threading.Lock()
+
+
 def unit_classes_dict_helper():
-    d = {cls.__name__: cls for cls in Unit.__subclasses__()}
-    return d
+    # Built once in unit_schema.py, the unit types do not change while the app runs
+    return UNIT_CLASSES
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_KEY') #  Needed for flashing messages
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///tale_vortex.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # The database itself is configured in storage.py
 
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+# Outside the static folder, exports are only served to their owner through the download routes
+app.config['EXPORT_FOLDER'] = os.path.join(app.instance_path, 'exports')
+# Seconds a browser may use a download without asking again, after that the ETag makes repeats cheap
+EXPORT_MAX_AGE = int(os.environ.get('EXPORT_MAX_AGE', 0))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # If set, /metrics requires it as bearer token
+# Without a token /metrics is off, METRICS_PUBLIC=1 serves it to anyone
+app.config['METRICS_PUBLIC'] = os.environ.get('METRICS_PUBLIC') == '1'
+
+BATCH_PREFILL_MAX_UNITS = int(os.environ.get('BATCH_PREFILL_MAX_UNITS', 25))
 
 
-db.init_app(app)  # Initialize the database
+init_storage(app, db)  # Initialize the database
+init_jobs(app)  # Background workers for LLM bound work
+
+app.jinja_env.filters['normalize_name'] = normalize_name
 
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
@@ -76,22 +110,30 @@ def load_user(user_id):
 @app.route('/')
 def index():
     if current_user.is_authenticated:
-        user_stories = Story.query.filter_by(user_id=current_user.id).all()
+        # The list only shows names, so only those columns are loaded
+        user_stories = db.session.query(Story.id, Story.name).filter_by(user_id=current_user.id).order_by(Story.id).all()
         selected_story_id = session.get('current_story_id')
         selected_story = None
         grouped_units = {}
+        undefined_names = []
         if selected_story_id:
-            selected_story = Story.query.get(selected_story_id)
-            # Sort units by unit_type
-            sorted_units = sorted(selected_story.units, key=lambda u: u.unit_type)
+            selected_story = Story.query.options(load_only(Story.id, Story.name, Story.user_id)).filter_by(
+                id=selected_story_id, user_id=current_user.id).first()
+        if selected_story is not None:  # Not "if selected_story", Story.__len__ would load all units
+            # One query for all units, sorted by unit_type in SQL
+            sorted_units = Unit.query.filter_by(story_id=selected_story.id).order_by(Unit.unit_type, Unit.id).all()
             # Group units by unit_type
             for unit_type, units in groupby(sorted_units, key=lambda u: u.unit_type):
                 grouped_units[unit_type] = list(units)
+            undefined_names = selected_story.undefined_names
         tp = render_template(
             'index.html',
             stories=user_stories,
             selected_story=selected_story,
             grouped_units=grouped_units,
+            undefined_names=undefined_names,
+            # Matched like UnitReference.target_normalized, see the normalize_name filter in index.html
+            undefined_name_set={normalize_name(name) for name in undefined_names},
             unit_classes_dict=unit_classes_dict_helper()
         )
         return tp
@@ -161,46 +203,36 @@ def add_unit(story_id, unit_type):
     if story.user_id != current_user.id:
         abort(403)
 
-    if unit_type not in unit_classes_dict_helper():
+    if unit_type not in UNIT_SCHEMAS:
         return "Invalid unit type", 400
 
-    unit_class = unit_classes_dict_helper()[unit_type]
-    feature_schema = unit_class.feature_schema
-
-    fields = prepare_fields(feature_schema, story, edit_mode=False)  # Moved up to be used in both GET and POST
+    unit_schema = UNIT_SCHEMAS[unit_type]
+    unit_class = unit_schema.unit_class
 
     if request.method == 'POST':
         action = request.form.get('action')
         form_data = request.form.to_dict(flat=False)
         if action == 'fill_features':
-            # Handle the OpenAI API call
+            # Generate the features in the background and let the browser poll for them
             description = request.form.get('unit_description', '').strip()
-
-            try:
-                msgs = feature_value_prefill_prompt(story, unit_type, description, feature_schema)
-                prefilled_features = call_openai(messages=msgs)
-                prefilled_features = json.loads(prefilled_features)
-                errors = None
-            except Exception as e:
-                prefilled_features = None
-                errors = [f"Error generating features: {e}"]
-
-            if prefilled_features:
-                # Update form_data with prefilled features
-                for key, value in prefilled_features.items():
-                    if key != 'name' and key != 'name_new':
-                        form_data[key] = value
-
-                # Keep the unit description in the form
-                form_data['unit_description'] = description
-
-                return render_template('add_unit.html', unit_type=unit_type, fields=fields, errors=[], form_data=MultiDict(form_data), story=story, edit_mode=False)
-            else:
-                return render_template('add_unit.html', unit_type=unit_type, fields=fields, errors=errors, form_data=request.form, story=story, edit_mode=False)
+            job = None
+            if SPECULATIVE_PREFILL and not description:
+                # Names of existing units in the form change the context of the prompt, other
+                # values (slider positions, new names) do not; looked up with the name index
+                if not story.get_units_by_names(referenced_names(form_data)):
+                    # Nothing was entered that would change the prompt of the speculative prefill
+                    job = take_speculative_prefill(story, unit_type, chosen_unit_name(form_data), form_data)
+            if job is None:
+                job = submit_llm_job('prefill', story, unit_type=unit_type,
+                                     description=description, form_data=form_data)
+            next_url = url_for('add_unit', story_id=story.id, unit_type=unit_type, job_id=job.id)
+            if job.finished:
+                return redirect(next_url)
+            return render_template('job_wait.html', job=job, story=story, next_url=next_url)
 
         elif action == 'save_unit':
             # Process form submission
-            features, errors = process_form_submission(form_data, feature_schema, story, unit_name=None)
+            features, errors = process_form_submission(form_data, unit_schema, story, unit_name=None)
 
             # Validate 'name' field
             name = features.get('name', '').strip()
@@ -214,33 +246,43 @@ def add_unit(story_id, unit_type):
 
             if errors:
                 # Re-render the form with error messages
-                fields = prepare_fields(feature_schema, story, edit_mode=False)
-                temp = render_template('add_unit.html', unit_type=unit_type, fields=fields, errors=errors, form_data=MultiDict(form_data), story=story, edit_mode=False)
-                return temp
+                return render_unit_form(unit_schema, story, form_data, errors, edit_mode=False)
             else:
                 # Create the Unit and add to the database
                 features['name'] = name  # Ensure name is set correctly
                 unit = unit_class(unit_type=unit_type, features=features, story_id=story.id)
                 db.session.add(unit)
-                db.session.commit()
-
-                # Save the updated undefined_names
-                if name in story.undefined_names:
-                    story.undefined_names.remove(name)
-                db.session.add(story)
-                db.session.commit()
-
-                # After committing, check if the new unit resolves any undefined names
-                update_references_with_new_unit(unit, story)
+                try:
+                    # One commit for the unit, its references and the names it resolves
+                    update_references_to_unit(unit, story)
+                    db.session.commit()
+                except IntegrityError:
+                    # The unique name index caught a unit added since the check above
+                    db.session.rollback()
+                    errors.append(f"A unit with the name '{name}' already exists in this story.")
+                    return render_unit_form(unit_schema, story, form_data, errors, edit_mode=False)
 
                 flash(f"{unit_type} '{name}' has been added.")
                 return redirect(url_for('index'))
 
     else:
-        # GET request, render form
-        fields = prepare_fields(feature_schema, story, edit_mode=False)
-        temp = render_template('add_unit.html', unit_type=unit_type, fields=fields, errors=[], form_data=MultiDict(), story=story, edit_mode=False)
-        return temp
+        job_id = request.args.get('job_id')
+        if job_id:
+            # Returning from the wait page of a "fill features" job
+            job = get_user_job(job_id)
+            if not job.finished:
+                return render_template('job_wait.html', job=job, story=story, next_url=request.url)
+            form_data, errors = prefill_job_form_data(job)
+            return render_unit_form(unit_schema, story, form_data, errors, edit_mode=False)
+
+        # GET request, render form (?name= preselects one of the undefined names)
+        name = request.args.get('name', '').strip()
+        if name not in story_names(story)[1]:  # The cached names the form shows anyway
+            name = ''
+        if SPECULATIVE_PREFILL:
+            start_speculative_prefill(story, unit_type, name)
+        form_data = MultiDict({'name': name}) if name else MultiDict()
+        return render_unit_form(unit_schema, story, form_data, [], edit_mode=False)
 
 
 @app.route('/story/<int:story_id>/download_json')
@@ -250,58 +292,189 @@ def download_story_json(story_id):
     if story.user_id != current_user.id:
         abort(403)
 
-    # Generate the JSON data
-    story_data = story.to_json()
-    json_str = json.dumps(story_data, indent=4)
+    # ?compact=1 leaves out the indentation, gzip is used if the client accepts it
+    compact = bool(request.args.get('compact'))
+    use_gzip = request.accept_encodings['gzip'] > 0
+    etag = export_etag(story, 'json-compact' if compact else 'json') + ('-gzip' if use_gzip else '')
+    response = not_modified_response(story, etag)
+    if response is not None:
+        response.vary.add('Accept-Encoding')
+        return response
 
-    # Create a BytesIO object
-    json_bytes = BytesIO(json_str.encode('utf-8'))
-    json_bytes.seek(0)  # Move to the beginning of the BytesIO object
+    # Streamed while the units are read, the story is never in memory as a whole
+    chunks = (chunk.encode('utf-8') for chunk in story.iter_json(indent=None if compact else 4))
+    if use_gzip:
+        chunks = gzip_chunks(chunks)
 
     # Set the filename (ensure it's safe for file systems)
-    from werkzeug.utils import secure_filename
     filename = secure_filename(f'{story.name}.json')
 
-    # Send the file
-    return send_file(
-        json_bytes,
-        as_attachment=True,
-        download_name=filename,
-        mimetype='application/json'
-    )
+    response = Response(stream_with_context(chunks), mimetype='application/json',
+                        headers={'Content-Disposition': f'attachment; filename={filename}', 'X-Accel-Buffering': 'no'})
+    if use_gzip:
+        response.content_encoding = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return export_cache_headers(response, story, etag)
+
+
+def gzip_chunks(chunks):
+    # gzip format (not raw deflate), flushed after every chunk so each part goes out right away
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def export_etag(story, kind, images_version=0):
+    '''
+    The ETag of an export of story. The story JSON changes with the story
+    revision, the PDF also with each new version of the full text, and the
+    board game PDFs with the board game revision and images_version, see
+    board_game_images_version.
+    '''
+    if kind == 'pdf':
+        return f'story-{story.id}-r{story.revision}-t{story.full_text_version}-{kind}'
+    if kind in ('json', 'json-compact'):
+        return f'story-{story.id}-r{story.revision}-{kind}'
+    return f'story-{story.id}-b{story.board_game_revision}-i{images_version}-{kind}'
+
 
-def prepare_fields(feature_schema, story, edit_mode=False):
+def board_game_images_version(story):
+    '''
+    The newest modification time (in ns) of the uploaded images of the board
+    game, 0 without images. An image can be replaced under the same filename
+    without a new board game revision.
+    '''
+    data = story.board_game_data or {}
+    filenames = set((data.get('images') or {}).values())
+    filenames.update(value for key, value in (data.get('texts') or {}).items() if key.endswith('_image_existing'))
+    mtimes = []
+    for filename in filenames:
+        if isinstance(filename, str) and filename:
+            path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(filename))
+            if os.path.exists(path):
+                mtimes.append(os.stat(path).st_mtime_ns)
+    return max(mtimes, default=0)
+
+
+def export_cache_headers(response, story, etag, last_modified=None):
+    response.set_etag(etag)
+    response.last_modified = last_modified or story.updated_at
+    if EXPORT_MAX_AGE:
+        response.cache_control.max_age = EXPORT_MAX_AGE
+    else:
+        response.cache_control.no_cache = True
+    return cache_export_privately(response)
+
+
+def cache_export_privately(response):
+    # Exports belong to one user, shared caches must not keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+def not_modified_response(story, etag, last_modified=None):
+    '''
+    A 304 response if the client already has this version of the export
+    (If-None-Match or If-Modified-Since), else None. last_modified defaults
+    to the last change of the story.
+    '''
+    last_modified = last_modified or story.updated_at
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    response = app.response_class(status=304)
+    return export_cache_headers(response, story, etag, last_modified)
+
+
+def send_export(story, path_or_file, etag, download_name, mimetype, last_modified=None):
+    response = send_file(path_or_file, as_attachment=True, download_name=download_name, mimetype=mimetype,
+                         etag=etag, last_modified=last_modified or story.updated_at, max_age=EXPORT_MAX_AGE)
+    return cache_export_privately(response)
+
+
+def send_board_game_pdf(story, kind, generate):
+    '''
+    Send one of the board game PDFs. It is generated (by generate, a Story
+    method) once per board game revision and version of its images and served
+    from the file after that.
+    '''
+    images_version = board_game_images_version(story)
+    etag = export_etag(story, kind, images_version)
+    last_modified = story.updated_at
+    if images_version:
+        images_modified = datetime.utcfromtimestamp(images_version / 1e9)
+        if last_modified is None or images_modified > last_modified:
+            last_modified = images_modified
+    response = not_modified_response(story, etag, last_modified)
+    if response is not None:
+        return response
+
+    export_folder = app.config['EXPORT_FOLDER']
+    output_path = os.path.join(export_folder,
+                               f'story_{story.id}_b{story.board_game_revision}_i{images_version}_{kind}.pdf')
+    if not os.path.exists(output_path):
+        os.makedirs(export_folder, exist_ok=True)
+        # Written under a temporary name, so a concurrent request never sends half a file
+        temp_path = f'{output_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        generate(story, temp_path)
+        os.replace(temp_path, output_path)
+        # PDFs of older board game revisions are never served again
+        for old_path in glob.glob(os.path.join(export_folder, f'story_{story.id}_b*_{kind}.pdf')):
+            if old_path != output_path:
+                os.remove(old_path)
+
+    return send_export(story, output_path, etag, f'{secure_filename(story.name)}_{kind}.pdf', 'application/pdf',
+                       last_modified)
+
+def story_names(story):
+    '''
+    The unit names and the undefined names of story, as (unit names, undefined
+    names), for the name options of the unit form. Cached per story revision;
+    every change to a unit makes a new revision, so an entry is never stale.
+    '''
+    with story_names_lock:
+        entry = story_names_cache.get(story.id)
+    if entry is not None and entry[0] == story.revision:
+        return entry[1], entry[2]
+    revision = story.revision
+    names = ([unit.name for unit in story.units], story.undefined_names)
+    with story_names_lock:
+        story_names_cache[story.id] = (revision, *names)
+    return names
+
+
+def prepare_fields(unit_schema, story, edit_mode=False):
+    '''
+    The fields of the unit form and the names offered for its list features.
+    The options are built once for all fields, add_unit.html shares them in one datalist.
+    '''
     fields = []
-    for feature_name, expected_type in feature_schema.items():
-        field = {'name': feature_name}
-        if feature_name == 'name':
+    unit_names, undefined_names = story_names(story)
+    for field_spec in unit_schema.fields:
+        field = {'name': field_spec.name}
+        if field_spec.name == 'name':
             if edit_mode:
                 field['type'] = 'str'
             else:
                 field['type'] = 'unitname'
-                field['options'] = [(name, name) for name in story.undefined_names]
+                field['options'] = [(name, name) for name in undefined_names]
             field['required'] = True
         else:
-            if expected_type == bool:
-                field['type'] = 'bool'
-            elif expected_type == float:
-                field['type'] = 'float'
-            elif expected_type == str:
-                field['type'] = 'str'
-            elif expected_type == int:
-                field['type'] = 'int'
+            field['type'] = field_spec.widget
+            if field_spec.widget == 'int':
                 raise ValueError  # this should never happen
-            elif expected_type == list:
-                field['type'] = 'list'
-                # Add undefined names to options
-                field['options'] = [
-                    (unit.name, unit.name)
-                    for unit in story.units
-                ] + [(name, name) for name in story.undefined_names]
-            else:
-                field['type'] = 'unknown'
         fields.append(field)
-    return fields
+    # Undefined names are offered too, so a unit can refer to one before it is created
+    return fields, unit_names + undefined_names
+
+
+def render_unit_form(unit_schema, story, form_data, errors, edit_mode=False):
+    fields, name_options = prepare_fields(unit_schema, story, edit_mode=edit_mode)
+    if not isinstance(form_data, MultiDict):
+        form_data = MultiDict(form_data)
+    return render_template('add_unit.html', unit_type=unit_schema.unit_type, fields=fields, name_options=name_options,
+                           errors=errors, form_data=form_data, story=story, edit_mode=edit_mode)
 
 @app.route('/story/<int:story_id>/download')
 @login_required
@@ -310,17 +483,83 @@ def download_story(story_id):
     if story.user_id != current_user.id:
         abort(403)
 
-    # Generate the PDF file
-    filename = f'pdf_files/story_{story.id}.pdf'
-    story.to_pdf(filename)
+    job_id = request.args.get('job_id')
+    if not job_id:
+        regenerate = bool(request.args.get('regenerate'))
+        pdf_path = story.pdf_path()
+        if not regenerate and os.path.exists(pdf_path):
+            # Nothing changed since the PDF was made
+            # A new text version keeps story.updated_at, the file's own time is the one that changes
+            etag = export_etag(story, 'pdf')
+            last_modified = datetime.utcfromtimestamp(os.path.getmtime(pdf_path))
+            response = not_modified_response(story, etag, last_modified)
+            if response is not None:
+                return response
+            return send_export(story, pdf_path, etag, os.path.basename(pdf_path), 'application/pdf', last_modified)
+
+        # Writing the full story takes a while, so it runs on the job queue
+        job = submit_llm_job('full_story', story, regenerate=regenerate)
+        return render_template('job_wait.html', job=job, story=story,
+                               next_url=url_for('download_story', story_id=story.id, job_id=job.id))
+
+    job = get_user_job(job_id)
+    if not job.finished:
+        return render_template('job_wait.html', job=job, story=story, next_url=request.url)
+    if job.status == 'failed':
+        flash(f"Error generating the story: {job.error}")
+        return redirect(url_for('index'))
 
     # Send the file to the client
     return send_file(
-        filename,
+        job.result['filename'],
         as_attachment=True,
         mimetype='application/pdf'
     )
 
+@app.route('/story/<int:story_id>')
+@login_required
+def read_story(story_id):
+    story = Story.query.get_or_404(story_id)
+    if story.user_id != current_user.id:
+        abort(403)
+
+    return render_template('story.html', story=story, unit_types=unit_classes_dict_helper().keys())
+
+
+@app.route('/story/<int:story_id>/stream_full_text')
+@login_required
+def stream_full_text(story_id):
+    story = Story.query.get_or_404(story_id)
+    if story.user_id != current_user.id:
+        abort(403)
+
+    def generate():
+        # Server-Sent Events, every piece is JSON encoded so newlines survive
+        try:
+            regenerate = bool(request.args.get('regenerate'))
+            stored_text = story.get_stored_full_text()
+            if stored_text and not regenerate:
+                yield f"data: {json.dumps(stored_text)}\n\n"
+            else:
+                for part in story.stream_full_text(use_cache=not regenerate):
+                    yield f"data: {json.dumps(part)}\n\n"
+                db.session.commit()
+        except LLMError as e:
+            yield f"event: error\ndata: {json.dumps(str(e))}\n\n"
+            return
+        except Exception as e:
+            print(f"Error streaming full story: {e}")
+            yield f"event: error\ndata: {json.dumps('The story could not be written.')}\n\n"
+            return
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/story/<int:story_id>/edit_unit/<unit_name>', methods=['GET', 'POST'])
 @login_required
 def edit_unit(story_id, unit_name):
@@ -332,43 +571,24 @@ def edit_unit(story_id, unit_name):
     if not unit:
         abort(404, description="Unit not found.")
 
-    unit_class = type(unit)
     unit_type = unit.unit_type
-    feature_schema = unit_class.feature_schema
+    unit_schema = UNIT_SCHEMAS[unit_type]
 
     if request.method == 'POST':
         # Process form submission
         action = request.form.get('action')
         form_data = request.form.to_dict(flat=False)
         if action == 'fill_features':
-            # Handle the OpenAI API call
+            # Generate the features in the background and let the browser poll for them
             description = request.form.get('unit_description', '').strip()
-
-            try:
-                msgs = feature_value_prefill_prompt(story, unit_type, description, feature_schema)
-                prefilled_features = call_openai(messages=msgs)
-                prefilled_features = json.loads(prefilled_features)
-                errors = None
-            except Exception as e:
-                prefilled_features = None
-                errors = [f"Error generating features: {e}"]
-
-            if prefilled_features:
-                # Update form_data with prefilled features
-                for key, value in prefilled_features.items():
-                    if key != 'name' and key != 'name_new':
-                        form_data[key] = value
-
-                # Keep the unit description in the form
-                form_data['unit_description'] = description
-
-                return render_template('add_unit.html', unit_type=unit_type, fields=prepare_fields(feature_schema, story, edit_mode=True), errors=[], form_data=MultiDict(form_data), story=story, edit_mode=True)
-            else:
-                return render_template('add_unit.html', unit_type=unit_type, fields=prepare_fields(feature_schema, story, edit_mode=True), errors=errors, form_data=request.form, story=story, edit_mode=True)
+            job = submit_llm_job('prefill', story, unit_type=unit_type,
+                                 description=description, form_data=form_data)
+            return render_template('job_wait.html', job=job, story=story,
+                                   next_url=url_for('edit_unit', story_id=story.id, unit_name=unit.name, job_id=job.id))
 
         elif action == 'save_unit':
             # Process form submission
-            features, errors = process_form_submission(form_data, feature_schema, story, unit_name=unit.name, edit_mode=True)
+            features, errors = process_form_submission(form_data, unit_schema, story, unit_name=unit.name, edit_mode=True)
 
             # Validate 'name' field
             new_name = features.get('name', '').strip()
@@ -382,29 +602,39 @@ def edit_unit(story_id, unit_name):
 
             if errors:
                 # Re-render the form with error messages
-                fields = prepare_fields(feature_schema, story, edit_mode=True)
-                return render_template('add_unit.html', unit_type=unit_type, fields=fields, errors=errors, form_data=form_data, story=story, edit_mode=True)
+                return render_unit_form(unit_schema, story, form_data, errors, edit_mode=True)
             else:
                 # Update the unit's features
+                old_name = unit.name
                 features['name'] = new_name  # Ensure name is set correctly
                 unit.features = features
                 db.session.add(unit)
                 db.session.add(story)
-                db.session.commit()
-
-                update_references_with_new_unit(unit, story)
-
-                refresh_undefined_names(story)
+                try:
+                    # A rename is carried over to the referencing units in the same transaction
+                    update_references_to_unit(unit, story, old_name)
+                    db.session.commit()
+                except IntegrityError:
+                    # The unique name index caught a unit renamed or added since the check above
+                    db.session.rollback()
+                    errors.append(f"A unit with the name '{new_name}' already exists in this story.")
+                    return render_unit_form(unit_schema, story, form_data, errors, edit_mode=True)
 
                 flash(f"{unit_type} '{new_name}' has been updated.")
                 return redirect(url_for('index'))
 
     else:
-        # GET request, render form with existing data
-        fields = prepare_fields(feature_schema, story, edit_mode=True)
-        form_data = MultiDict(unit.features)
+        job_id = request.args.get('job_id')
+        if job_id:
+            # Returning from the wait page of a "fill features" job
+            job = get_user_job(job_id)
+            if not job.finished:
+                return render_template('job_wait.html', job=job, story=story, next_url=request.url)
+            form_data, errors = prefill_job_form_data(job)
+            return render_unit_form(unit_schema, story, form_data, errors, edit_mode=True)
 
-        return render_template('add_unit.html', unit_type=unit_type, fields=fields, errors=[], form_data=form_data, story=story, edit_mode=True)
+        # GET request, render form with existing data
+        return render_unit_form(unit_schema, story, unit.features, [], edit_mode=True)
 
 
 @app.route('/story/<int:story_id>/create_board_game', methods=['GET', 'POST'])
@@ -446,49 +676,20 @@ def create_board_game(story_id):
         return redirect(url_for('index'))
 
     else:
-        # Generate prefilled data using ChatGPT
-        prompt = story.create_board_game_prompt()
-        messages = [
-            {"role": "system",
-             "content": "You are an assistant that helps creating a board adventure game. Your job is to extract information out of the story and return relevant pieces in a JSON."},
-            {"role": "user", "content": prompt}
-        ]
-        try:
-            assistant_reply = call_openai(messages)
-            prefilled_data = json.loads(assistant_reply)
-        except Exception as e:
-            print(f"Error generating prefilled data: {e}")
-            prefilled_data = {}
-
-        # Now generate images for each location and NPC
-        # Ensure the UPLOAD_FOLDER exists
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-        # Generate images for locations
-        for location in prefilled_data.get('locations', []):
-            location_name = location.get('name', 'Unknown Location')
-            # Create a prompt for the image generation
-            image_prompt = f"An illustration of {location_name} in the setting of {story.setting_and_style}."
-            # Generate a secure filename
-            filename = secure_filename(f"location_{location_name}.png")
-            # Generate and save the image
-            image_filename = generate_and_save_image(image_prompt, filename)
-            # Add the image filename to the location data
-            if image_filename:
-                location['image_filename'] = image_filename
-
-        # Generate images for NPCs
-        for npc in prefilled_data.get('npcs', []):
-            npc_name = npc.get('name', 'Unknown NPC')
-            # Create a prompt for the image generation
-            image_prompt = f"A portrait of {npc_name} in the style of {story.setting_and_style}."
-            # Generate a secure filename
-            filename = secure_filename(f"npc_{npc_name}.png")
-            # Generate and save the image
-            image_filename = generate_and_save_image(image_prompt, filename)
-            # Add the image filename to the NPC data
-            if image_filename:
-                npc['image_filename'] = image_filename
+        job_id = request.args.get('job_id')
+        if not job_id:
+            # Generate prefilled data using ChatGPT on the job queue
+            job = submit_llm_job('board_game', story)
+            return render_template('job_wait.html', job=job, story=story,
+                                   next_url=url_for('create_board_game', story_id=story.id, job_id=job.id))
+
+        job = get_user_job(job_id)
+        if not job.finished:
+            return render_template('job_wait.html', job=job, story=story, next_url=request.url)
+        if job.status == 'failed':
+            flash(f"Error generating the board game: {job.error}")
+            return redirect(url_for('index'))
+        prefilled_data = job.result
 
         temp = render_template('create_board_game.html', prefilled_data=prefilled_data, story=story)
         return temp
@@ -501,10 +702,7 @@ def download_npc_pdf(story_id):
     if story.user_id != current_user.id:
         abort(403)
 
-    output_path = f'static/exports/{secure_filename(story.name)}_npcs.pdf'
-    story.generate_npc_pdf(output_path)
-
-    return send_from_directory(directory='static/exports', path=f'{secure_filename(story.name)}_npcs.pdf', as_attachment=True)
+    return send_board_game_pdf(story, 'npcs', Story.generate_npc_pdf)
 
 @app.route('/story/<int:story_id>/download_location_pdf')
 @login_required
@@ -513,10 +711,7 @@ def download_location_pdf(story_id):
     if story.user_id != current_user.id:
         abort(403)
 
-    output_path = f'static/exports/{secure_filename(story.name)}_locations.pdf'
-    story.generate_location_pdf(output_path)
-
-    return send_from_directory(directory='static/exports', path=f'{secure_filename(story.name)}_locations.pdf', as_attachment=True)
+    return send_board_game_pdf(story, 'locations', Story.generate_location_pdf)
 
 @app.route('/story/<int:story_id>/download_additional_text_pdf')
 @login_required
@@ -525,12 +720,325 @@ def download_additional_text_pdf(story_id):
     if story.user_id != current_user.id:
         abort(403)
 
-    output_path = f'static/exports/{secure_filename(story.name)}_additional_texts.pdf'
-    story.generate_additional_text_pdf(output_path)
+    return send_board_game_pdf(story, 'additional_texts', Story.generate_additional_text_pdf)
 
-    return send_from_directory(directory='static/exports', path=f'{secure_filename(story.name)}_additional_texts.pdf', as_attachment=True)
 
 
+@app.route('/story/<int:story_id>/jobs/<kind>', methods=['POST'])
+@login_required
+def submit_story_job(story_id, kind):
+    story = Story.query.get_or_404(story_id)
+    if story.user_id != current_user.id:
+        abort(403)
+
+    payload = request.get_json(silent=True) or request.form.to_dict()
+    if not isinstance(payload, dict):
+        return {'error': 'The body must be a JSON object.'}, 400
+    if kind == 'prefill':
+        unit_type = payload.get('unit_type')
+        if not isinstance(unit_type, str) or unit_type not in unit_classes_dict_helper():
+            return {'error': 'Invalid unit type'}, 400
+        if not isinstance(payload.get('description', ''), str):
+            return {'error': "'description' must be a string."}, 400
+        job = submit_llm_job('prefill', story, unit_type=payload['unit_type'],
+                             description=payload.get('description', '').strip(), form_data={})
+    elif kind in ('board_game', 'full_story'):
+        job = submit_llm_job(kind, story)
+    else:
+        return {'error': f"Unknown job kind '{kind}'"}, 400
+
+    return {'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}, 202
+
+
+@app.route('/story/<int:story_id>/batch_prefill', methods=['POST'])
+@login_required
+def batch_prefill(story_id):
+    '''
+    Prefill several units with a single LLM request. The JSON body is either
+    {"units": [{"unit_type": ..., "description": ...}, ...]} or
+    {"undefined_names": true} to prefill a unit for every undefined name.
+    Returns a job whose result holds the features and errors for each unit.
+    '''
+    story = Story.query.get_or_404(story_id)
+    if story.user_id != current_user.id:
+        abort(403)
+
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return {'error': 'The body must be a JSON object.'}, 400
+    unit_classes = unit_classes_dict_helper()
+    if payload.get('undefined_names'):
+        # The model picks the unit type for each name
+        items = [{'unit_type': None, 'name': name, 'description': ''} for name in story.undefined_names]
+    else:
+        units = payload.get('units', [])
+        if not isinstance(units, list) or not all(isinstance(item, dict) for item in units):
+            return {'error': "'units' must be a list of objects."}, 400
+        items = []
+        for item in units:
+            unit_type = item.get('unit_type')
+            if not isinstance(unit_type, str) or unit_type not in unit_classes:
+                return {'error': f"Invalid unit type '{unit_type}'"}, 400
+            if not all(isinstance(item.get(key) or '', str) for key in ('name', 'description')):
+                return {'error': "'name' and 'description' must be strings."}, 400
+            items.append({
+                'unit_type': item['unit_type'],
+                'name': (item.get('name') or '').strip() or None,
+                'description': (item.get('description') or '').strip()
+            })
+
+    if not items:
+        return {'error': 'Nothing to prefill.'}, 400
+    if len(items) > BATCH_PREFILL_MAX_UNITS:
+        return {'error': f"At most {BATCH_PREFILL_MAX_UNITS} units can be prefilled at once."}, 400
+
+    job = submit_llm_job('batch_prefill', story, items=items)
+    return {'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id),
+            'result_url': url_for('job_result', job_id=job.id)}, 202
+
+
+@app.route('/metrics')
+def metrics():
+    '''
+    LLM and request metrics in the Prometheus text format: request, error and
+    token counts per route. Not tied to a login: with METRICS_TOKEN set the
+    scraper sends it as bearer token, with METRICS_PUBLIC=1 the endpoint is
+    open to everyone, otherwise it answers 404.
+    '''
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+    elif not app.config['METRICS_PUBLIC']:
+        abort(404)
+
+    cache_stats = llm_cache.stats()
+    gauges = {
+        'llm_cache_hits': cache_stats['hits'],
+        'llm_cache_memory_hits': cache_stats['memory_hits'],
+        'llm_cache_disk_hits': cache_stats['disk_hits'],
+        'llm_cache_misses': cache_stats['misses'],
+        'llm_cache_memory_entries': cache_stats['memory_entries'],
+    }
+    return Response(llm_metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = get_user_job(job_id)
+    return job.to_json()
+
+
+@app.route('/jobs/<job_id>/result')
+@login_required
+def job_result(job_id):
+    job = get_user_job(job_id)
+    if job.status == 'failed':
+        return {'error': job.error}, 500
+    if not job.finished:
+        return job.to_json(), 202
+    return {'result': job.result}
+
+
+def submit_llm_job(kind, story, **payload):
+    # Refuse right away when the user is out of quota, instead of queueing a job that is bound to fail
+    llm_limiter.check(current_user.id)
+    return submit_job(kind, current_user.id, story_id=story.id, **payload)
+
+
+@app.errorhandler(LLMBusyError)
+def llm_busy(e):
+    headers = {'Retry-After': str(e.retry_after)}
+    if request.is_json or request.accept_mimetypes.best == 'application/json':
+        return {'error': str(e), 'retry_after': e.retry_after}, 429, headers
+    return str(e), 429, headers
+
+
+def get_user_job(job_id):
+    job = db.session.get(Job, job_id)
+    if job is None:
+        abort(404, description="Job not found.")
+    if job.user_id != current_user.id:
+        abort(403)
+    return fail_lost_job(job)
+
+
+def prefill_job_form_data(job):
+    '''
+    Turn a finished prefill job into the form data and errors for add_unit.html.
+    '''
+    form_data = job.payload.get('form_data', {})
+    if job.status == 'failed':
+        return MultiDict(form_data), [f"Error generating features: {job.error}"]
+
+    # Update form_data with prefilled features
+    for key, value in job.result.items():
+        if key != 'name' and key != 'name_new':
+            form_data[key] = value
+
+    # Keep the unit description in the form
+    form_data['unit_description'] = job.payload.get('description', '')
+    return MultiDict(form_data), []
+
+
+def chosen_unit_name(form_data):
+    '''
+    The name picked in the add unit form (form_data as from to_dict(flat=False)),
+    a new name wins over a selected undefined one like in process_form_submission.
+    '''
+    new_name = form_data.get('name_new', [''])[0].strip()
+    return new_name or form_data.get('name', [''])[0].strip()
+
+
+def start_speculative_prefill(story, unit_type, name):
+    '''
+    Start the prefill that "fill features" without a description would start,
+    before the user asks for it. Does nothing if one is already known or the
+    user is out of LLM quota (the real click then reports that).
+    '''
+    key = (story.id, story.revision, unit_type, name)  # A changed story needs a new prefill
+    job_id = speculations.get(current_user.id, key)
+    if job_id:
+        job = db.session.get(Job, job_id)
+        if job is not None and job.status != 'failed':
+            return
+    try:
+        llm_limiter.check(current_user.id)
+    except LLMBusyError:
+        return
+    form_data = {'name': [name]} if name else {}
+    job = submit_job('prefill', current_user.id, story_id=story.id, unit_type=unit_type,
+                     description='', form_data=form_data)
+    speculations.put(current_user.id, key, job.id)
+
+
+def take_speculative_prefill(story, unit_type, name, form_data):
+    '''
+    Return the speculative prefill job for this form (running or done) or None.
+    The job takes over the submitted form_data so that the result page keeps it.
+    '''
+    job_id = speculations.pop(current_user.id, (story.id, story.revision, unit_type, name))
+    job = db.session.get(Job, job_id) if job_id else None
+    if job is None or job.user_id != current_user.id or job.status == 'failed':
+        return None
+    job.payload['form_data'] = form_data
+    db.session.commit()
+    return job
+
+
+@job_handler('prefill')
+def prefill_job(story_id, unit_type, description, form_data):
+    story = db.session.get(Story, story_id)
+    unit_schema = UNIT_SCHEMAS[unit_type]
+    msgs = feature_value_prefill_prompt(story, unit_type, description, form_data)
+    reply = call_openai_json(msgs, route='prefill', user_id=story.user_id, response_format=unit_schema.response_format)
+    prefilled_features, errors = unit_schema.coerce_generated(reply)
+    if errors:
+        print(f"Prefilled features needed fixing: {errors}")
+    return prefilled_features
+
+
+@job_handler('batch_prefill')
+def batch_prefill_job(story_id, items):
+    story = db.session.get(Story, story_id)
+    unit_classes = unit_classes_dict_helper()
+    msgs = batch_prefill_prompt(story, items)
+    # The features differ per unit type, so this is plain JSON mode instead of one strict schema
+    reply = call_openai_json(msgs, route='batch_prefill', user_id=story.user_id)
+
+    replies_by_index = {}
+    for unit_reply in reply.get('units', []) if isinstance(reply, dict) else []:
+        if isinstance(unit_reply, dict) and isinstance(unit_reply.get('index'), int):
+            replies_by_index[unit_reply['index']] = unit_reply
+
+    results = []
+    for index, item in enumerate(items):
+        result = {'unit_type': item['unit_type'], 'name': item['name'], 'description': item['description'],
+                  'features': None, 'errors': []}
+        results.append(result)
+
+        unit_reply = replies_by_index.get(index)
+        if unit_reply is None:
+            result['errors'].append("No features were generated for this unit.")
+            continue
+        unit_type = item['unit_type'] or unit_reply.get('unit_type')
+        if unit_type not in unit_classes:
+            result['errors'].append(f"Invalid unit type '{unit_type}'.")
+            continue
+        result['unit_type'] = unit_type
+
+        features, errors = UNIT_SCHEMAS[unit_type].coerce_generated(unit_reply.get('features') or {})
+        if item['name']:
+            features['name'] = item['name']
+        result['features'] = features
+        result['errors'].extend(errors)
+
+    return {'units': results}
+
+
+@job_handler('full_story')
+def full_story_job(story_id, regenerate=False):
+    story = db.session.get(Story, story_id)
+    filename = story.pdf_path()
+    if regenerate or not os.path.exists(filename):
+        filename = story.to_pdf(regenerate=regenerate)
+        # PDFs of older revisions and texts are never served again
+        for old_filename in glob.glob(os.path.join(os.path.dirname(filename), f'story_{story.id}_r*.pdf')):
+            if old_filename != filename:
+                os.remove(old_filename)
+    return {'filename': filename}
+
+
+@job_handler('board_game')
+def board_game_job(story_id):
+    story = db.session.get(Story, story_id)
+    prompt = story.create_board_game_prompt()
+    messages = [
+        {"role": "system",
+         "content": "You are an assistant that helps creating a board adventure game. Your job is to extract information out of the story and return relevant pieces in a JSON."},
+        {"role": "user", "content": prompt}
+    ]
+    try:
+        prefilled_data = call_openai_json(messages, route='board_game', user_id=story.user_id)
+        if not isinstance(prefilled_data, dict):
+            raise ValueError("The board game is not a JSON object.")
+    except ValueError as e:
+        print(f"Error generating prefilled data: {e}")
+        prefilled_data = {}
+
+    # Now generate images for each location and NPC
+    # Ensure the UPLOAD_FOLDER exists
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    # Generate images for locations
+    for location in prefilled_data.get('locations', []):
+        location_name = location.get('name', 'Unknown Location')
+        # Create a prompt for the image generation
+        image_prompt = f"An illustration of {location_name} in the setting of {story.setting_and_style}."
+        # Generate a secure filename
+        filename = secure_filename(f"location_{location_name}.png")
+        # Generate and save the image
+        image_filename = generate_and_save_image(image_prompt, filename)
+        # Add the image filename to the location data
+        if image_filename:
+            location['image_filename'] = image_filename
+
+    # Generate images for NPCs
+    for npc in prefilled_data.get('npcs', []):
+        npc_name = npc.get('name', 'Unknown NPC')
+        # Create a prompt for the image generation
+        image_prompt = f"A portrait of {npc_name} in the style of {story.setting_and_style}."
+        # Generate a secure filename
+        filename = secure_filename(f"npc_{npc_name}.png")
+        # Generate and save the image
+        image_filename = generate_and_save_image(image_prompt, filename)
+        # Add the image filename to the NPC data
+        if image_filename:
+            npc['image_filename'] = image_filename
+
+    return prefilled_data
+
 
 def generate_and_save_image(prompt, filename):
     with Image.open('default_image.jpg') as img:
@@ -670,124 +1178,90 @@ def logout():
     return redirect(url_for('index'))
 
 
-def update_references_with_new_unit(unit, story):
-    new_unit_name = unit.name
-    if new_unit_name in story.undefined_names:
-        for u in story.units:
-            # Skip the unit we just added
-            if u.name == new_unit_name:
+def update_references_to_unit(unit, story, old_name=None):
+    '''
+    Make the list features that refer to unit use its current name: references
+    to old_name after a rename, and differently spelled references to the
+    name of a new unit. Only the units that the unit_reference index names are
+    loaded and changed. The caller commits.
+    '''
+    names = {normalize_name(unit.name)}
+    if old_name:
+        names.add(normalize_name(old_name))
+
+    # The query flushes the unit first, so the references of a rename are already unresolved
+    referencing_units = Unit.query.join(UnitReference, UnitReference.source_unit_id == Unit.id).filter(
+        UnitReference.story_id == story.id,
+        UnitReference.target_normalized.in_(names)
+    ).distinct().all()
+
+    for u in referencing_units:
+        for key, value in list(u.features.items()):
+            # Skip updating the 'name' field
+            if key == 'name' or not isinstance(value, list):
                 continue
-            updated = False
-            for key, value in u.features.items():
-                # Skip updating the 'name' field
-                if key == 'name':
-                    continue  # Do not update the 'name' field
-                if value == new_unit_name:
-                    updated = True
-                elif isinstance(value, list):
-                    # Replace any occurrences in lists
-                    new_list = []
-                    for item in value:
-                        if item == new_unit_name:
-                            new_list.append(new_unit_name)
-                            updated = True
-                        else:
-                            new_list.append(item)
-                    u.features[key] = new_list
-            if updated:
-                db.session.add(u)
-        # Remove the resolved name from undefined_names
-        story.undefined_names.remove(new_unit_name)
-        db.session.add(story)
-        db.session.commit()
-
-
-def process_form_submission(form_data, feature_schema, story, unit_name=None, edit_mode=False):
+            new_list = []
+            listed = unit.name in value
+            for item in value:
+                if isinstance(item, str) and item != unit.name and normalize_name(item) in names:
+                    # A rewritten reference is dropped where the unit is already listed,
+                    # every other entry (duplicates included) stays as it was
+                    if listed:
+                        continue
+                    listed = True
+                    item = unit.name
+                new_list.append(item)
+            if new_list != value:
+                u.features[key] = new_list
+
+
+def process_form_submission(form_data, unit_schema, story, unit_name=None, edit_mode=False):
+    '''
+    Turn the submitted form into features and errors. Nothing is written here,
+    the caller saves the unit with everything that follows from it in one commit.
+    '''
     features = {}
     errors = []
 
+    # Look up every name the list features refer to with one query
+    units_by_name = story.get_units_by_names(unit_schema.submitted_names(form_data))
 
-    for feature_name, expected_type in feature_schema.items():
-        if feature_name == 'name':
+    for field in unit_schema.fields:
+        if field.name == 'name':
             if edit_mode:
-                name = form_data.get(feature_name, [''])[0].strip()
+                name = form_data.get(field.name, [''])[0].strip()
             else:
-                selected_name = form_data.get(feature_name, [''])[0].strip()
-                new_name = form_data.get(f"{feature_name}_new", [''])[0].strip()
+                selected_name = form_data.get(field.name, [''])[0].strip()
+                new_name = form_data.get(f"{field.name}_new", [''])[0].strip()
                 if not selected_name and not new_name:
                     errors.append("Please select a name from the dropdown or provide a new name.")
                 name = new_name if new_name else selected_name
-            features[feature_name] = name
+            if len(name) > NAME_MAX_LENGTH:
+                # Would not fit the normalized_name column
+                errors.append(f"The name must not be longer than {NAME_MAX_LENGTH} characters.")
+            features[field.name] = name
             continue
 
-        value = form_data.get(feature_name, [''])[0]
-        new_value = form_data.get(f"{feature_name}_new", [''])[0].strip()
-
-        if expected_type == bool:
-            features[feature_name] = (value == 'on')
-        elif expected_type == float:
-            try:
-                features[feature_name] = float(value) if value else 0.0
-            except ValueError:
-                errors.append(f"Invalid value for {feature_name}.")
-                features[feature_name] = 0.0
-        elif expected_type == str:
-            features[feature_name] = value.strip() if value else ''
-        elif expected_type == int:
-            try:
-                features[feature_name] = int(value) if value else 1
-            except ValueError:
-                errors.append(f"Invalid value for {feature_name}.")
-                features[feature_name] = 1
-        elif expected_type == list:
-            selected_values = form_data.get(feature_name)
-            if not selected_values:
-                selected_values = []
-            new_values = form_data.get(feature_name + '_new', '')[0].split(', ')
-
-            selected_and_new_values = selected_values + new_values
-            if '' in selected_and_new_values:
-                selected_and_new_values.remove('')
-                if '' in selected_and_new_values:
-                    selected_and_new_values.remove('')
-            combined_values = []
-
-            # Add existing unit names
-            for v in selected_and_new_values:
-                related_unit = story.get_unit_by_name(v.strip())
-                if related_unit:
-                    combined_values.append(related_unit.name)
-                else:
-                    combined_values.append(v.strip())
-                    if combined_values[-1] not in story.undefined_names:
-                        story.undefined_names.append(combined_values[-1])
-                        db.session.add(story)
-            db.session.commit()
-            features[feature_name] = combined_values
-        else:
-            # Unsupported type
-            errors.append(f"Unsupported type for {feature_name}.")
-            features[feature_name] = value
+        features[field.name], error = field.from_form(form_data, units_by_name)
+        if error:
+            errors.append(error)
 
     return features, errors
 
-def refresh_undefined_names(story):
-    # Recalculate undefined names based on current units
-    all_referenced_names = set()
-    existing_unit_names = set(unit.name for unit in story.units)
-
-    for unit in story.units:
-        for feature_name, value in unit.features.items():
-            if isinstance(value, str):
-                if value not in existing_unit_names and value:
-                    all_referenced_names.add(value)
-            elif isinstance(value, list):
-                for item in value:
-                    if item not in existing_unit_names and item:
-                        all_referenced_names.add(item)
-    story.undefined_names = list(all_referenced_names)
-    db.session.add(story)
-    db.session.commit()
+@app.cli.command('rebuild-references')
+@click.option('--story-id', type=int, help="Only rebuild this story.")
+def rebuild_references_command(story_id):
+    '''
+    Recreate the unit_reference rows, and with them the undefined names, from
+    the units' features. Saves keep them up to date, this is for repairs.
+    '''
+    stories = [db.session.get(Story, story_id)] if story_id else Story.query.all()
+    for story in stories:
+        if story is None:
+            raise click.BadParameter(f"There is no story {story_id}.")
+        rebuild_unit_references(story)
+        db.session.commit()
+        print(f"Story {story.id}: {len(story.undefined_names)} undefined names")
 
 
 def getToken():
@@ -833,9 +1307,15 @@ def send_emails(host, port, subject, msg, sender, recipients):
     server.quit()
 
 
-def feature_value_prefill_prompt(story, unit_type, description, feature_schema):
+def feature_value_prefill_prompt(story, unit_type, description, features=None):
+    # Only the units most related to the description and to the names already
+    # filled into the form (features) are sent in full, see context_selection.py
+    story_context = select_context(story, description, features)
     if not description:
         description = f"The {unit_type} should fit well within the story."
+    name = chosen_unit_name(features or {})
+    if name:
+        description += f" Its name is '{name}'."
     prompt = f"""Based on the following story information and the description, please provide values for the features of the unit type '{unit_type}' in JSON format.
 A Unit is an element of the story.
 
@@ -845,8 +1325,8 @@ Story Setting and Style:
 Main Challenge:
 {story.main_challenge}
 
-All already existing units of the story:
-{story.to_text_list()}
+All already existing units of the story (the most relevant ones in detail):
+{story_context}
 
 Description of the {unit_type} to create:
 {description}
@@ -857,8 +1337,7 @@ Please provide a JSON object with the following keys and appropriate values:
 
     # List the features
     prompt += "Features:\n"
-    for feature_name, expected_type in feature_schema.items():
-        prompt += f"- '{feature_name}' ({expected_type.__name__ if not isinstance(expected_type, tuple) else 'list'}): {expected_type}\n"
+    prompt += UNIT_SCHEMAS[unit_type].prompt_lines
 
     prompt += """
 
@@ -883,7 +1362,91 @@ Do not use the word "json" or quotation marks of any kind outside the json.
     ]
     return messages
 
+def batch_prefill_prompt(story, items):
+    unit_classes = unit_classes_dict_helper()
+    descriptions = ' '.join(f"{item['name'] or ''} {item['description']}" for item in items)
+    story_context = select_context(story, descriptions)
+
+    prompt = f"""Based on the following story information, please provide values for the features of several new units of the story in JSON format.
+A Unit is an element of the story.
+
+Story Setting and Style:
+{story.setting_and_style}
+
+Main Challenge:
+{story.main_challenge}
+
+All already existing units of the story (the most relevant ones in detail):
+{story_context}
+
+Units to create:
+"""
+    unit_types = set()
+    for index, item in enumerate(items):
+        if item['unit_type']:
+            unit_type = item['unit_type']
+            unit_types.add(unit_type)
+        else:
+            unit_type = f"one of {', '.join(unit_classes)}, whichever fits best"
+            unit_types.update(unit_classes)
+        description = item['description'] or "It should fit well within the story."
+        prompt += f"- Unit {index}: unit type {unit_type}. {description}"
+        if item['name']:
+            prompt += f" Its name must be '{item['name']}'."
+        prompt += "\n"
+
+    # List the features of every unit type involved once
+    prompt += "\nFeatures of the unit types:\n"
+    for unit_type in sorted(unit_types):
+        prompt += f"{unit_type}:\n"
+        prompt += UNIT_SCHEMAS[unit_type].short_prompt_lines
+
+    prompt += """
+
+Example response:
+{
+    "units": [
+        {
+            "index": 0,
+            "unit_type": "Character",
+            "features": {
+                "name": "Name of the unit",
+                "feature1": "value1",
+                "feature2": true,
+                "feature3": 0.5,
+                "feature4": ["Name of another unit"]
+            }
+        }
+    ]
+}
+
+Please provide exactly one entry per unit to create, with the index given above.
+Please ensure the response is valid JSON, starting with the first opening bracket "{" and ending with the last closing bracket "}".
+Do not use the word "json" or quotation marks of any kind outside the json.
+"""
+
+    messages = [
+        {"role": "system",
+         "content": "You are an assistant that helps fill out feature values for units in a story based on a description."},
+        {"role": "user", "content": prompt}
+    ]
+    return messages
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    '''
+    Create the database or bring its schema up to date, see migrations.py.
+    '''
+    with app.app_context():
+        applied = upgrade(db.engine)
+    for description in applied:
+        print(description)
+    if not applied:
+        print("The database is up to date.")
+
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()  # Create tables if they don't exist
+        upgrade(db.engine)  # Create or upgrade the tables
     app.run(debug=False, host="0.0.0.0")
@@ -0,0 +1,126 @@
+# context_selection.py
+import os
+from collections import deque
+
+from models import normalize_name
+from openai_client import estimate_tokens
+
+PREFILL_CONTEXT_TOKENS = int(os.environ.get('PREFILL_CONTEXT_TOKENS', 3000))
+# Units up to this many references away from the new unit are shown with all their features
+FULL_DETAIL_DISTANCE = int(os.environ.get('PREFILL_FULL_DETAIL_DISTANCE', 2))
+
+
+def referenced_names(features):
+    '''
+    Collect the unit names a feature dict refers to. Works for unit features as
+    well as for submitted form data (lists of values and comma-separated "_new" fields).
+    '''
+    names = set()
+    for feature_name, value in (features or {}).items():
+        if feature_name in ('name', 'action', 'unit_description'):
+            continue
+        values = value if isinstance(value, list) else [value]
+        for item in values:
+            if not isinstance(item, str):
+                continue
+            if feature_name.endswith('_new'):
+                names.update(normalize_name(part) for part in item.split(',') if part.strip())
+            elif item.strip():
+                names.add(normalize_name(item))
+    return names
+
+
+def unit_distances(units, seed_names):
+    '''
+    Breadth-first search over the references between units, starting at the
+    units named in seed_names. Returns a dict of unit id to distance.
+    '''
+    by_name = {normalize_name(unit.name): unit for unit in units}
+    neighbours = {unit.id: set() for unit in units}
+    for unit in units:
+        for name in referenced_names(unit.features):
+            other = by_name.get(name)
+            if other is not None and other.id != unit.id:
+                neighbours[unit.id].add(other.id)
+                neighbours[other.id].add(unit.id)
+
+    distances = {}
+    queue = deque()
+    for name in seed_names:
+        unit = by_name.get(name)
+        if unit is not None and unit.id not in distances:
+            distances[unit.id] = 0
+            queue.append(unit.id)
+    while queue:
+        unit_id = queue.popleft()
+        for other_id in neighbours[unit_id]:
+            if other_id not in distances:
+                distances[other_id] = distances[unit_id] + 1
+                queue.append(other_id)
+    return distances
+
+
+def select_context(story, description, features=None, token_budget=PREFILL_CONTEXT_TOKENS):
+    '''
+    Render the story for a prefill prompt within token_budget. Units close (in
+    the reference graph) to the names mentioned in the description or in the
+    unit's list features are shown in full, the others by name and, while the
+    budget allows, in full as well. Whatever does not fit is left out.
+    Small stories therefore come out exactly like story.to_text_list().
+    '''
+    units = list(story.units)
+    description = normalize_name(description)
+    seed_names = referenced_names(features)
+    seed_names.update(normalize_name(unit.name) for unit in units if unit.name and normalize_name(unit.name) in description)
+    distances = unit_distances(units, seed_names)
+
+    lines = story.header_text_lines()
+    budget_left = token_budget - estimate_tokens("\n".join(lines))
+    unit_dict = {normalize_name(unit.name): unit for unit in units}
+    selected = {}  # Position in the story -> rendered lines
+
+    # Closest units first, story order breaks ties
+    infinity = float('inf')
+    ranked = sorted(enumerate(units), key=lambda pair: (distances.get(pair[1].id, infinity), pair[0]))
+    near = [(position, unit) for position, unit in ranked if distances.get(unit.id, infinity) <= FULL_DETAIL_DISTANCE]
+    far = [(position, unit) for position, unit in ranked if distances.get(unit.id, infinity) > FULL_DETAIL_DISTANCE]
+
+    def summary_lines(unit):
+        return [f"{unit.unit_type}: {unit.name} (details left out)", ""]
+
+    def try_select(position, lines_):
+        nonlocal budget_left
+        cost = estimate_tokens("\n".join(lines_))
+        if cost > budget_left:
+            return False
+        budget_left -= cost
+        selected[position] = lines_
+        return True
+
+    # Nearby units in full, or at least by name
+    for position, unit in near:
+        if not try_select(position, story.unit_text_lines(unit, unit_dict)):
+            try_select(position, summary_lines(unit))
+
+    # Everything else by name first, so the model knows which names exist ...
+    for position, unit in far:
+        try_select(position, summary_lines(unit))
+
+    # ... and in full with whatever budget is left
+    for position, unit in far:
+        if position not in selected:
+            continue
+        summary_cost = estimate_tokens("\n".join(selected[position]))
+        unit_lines = story.unit_text_lines(unit, unit_dict)
+        if estimate_tokens("\n".join(unit_lines)) <= budget_left + summary_cost:
+            budget_left += summary_cost
+            try_select(position, unit_lines)
+        elif budget_left < summary_cost:
+            break
+
+    for position in sorted(selected):
+        lines.extend(selected[position])
+    left_out = len(units) - len(selected)
+    if left_out:
+        lines.append(f"({left_out} more units are not shown.)")
+    return "\n".join(lines)
@@ -0,0 +1,234 @@
+'''
+Offline stand-in for the OpenAI chat completions API, for tests and load runs.
+
+    python fake_openai_server.py --port 8001 --latency lognormal --latency-mean 2 --error-429 0.05
+    OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=fake python app.py
+
+Replies are canned but valid: prefill requests get features matching the unit
+type's feature_schema, board game requests get the board game structure and
+everything else gets a bit of story prose. Streaming is supported.
+'''
+import argparse
+import json
+import math
+import random
+import re
+import time
+import uuid
+
+from flask import Flask, Response, request
+
+from models import Unit
+from openai_client import estimate_prompt_tokens, estimate_tokens
+
+fake_app = Flask(__name__)
+fake_app.config.update(
+    LATENCY='fixed',  # fixed, uniform or lognormal
+    LATENCY_MEAN=0.5,  # Seconds until the reply (or the first token when streaming)
+    LATENCY_SIGMA=0.5,
+    TOKEN_DELAY=0.01,  # Seconds between streamed tokens
+    ERROR_429=0.0,  # Probability of answering with a rate limit error
+    ERROR_500=0.0,  # Probability of answering with a server error
+    ERROR_TIMEOUT=0.0,  # Probability of not answering before TIMEOUT_DELAY
+    TIMEOUT_DELAY=600,
+)
+
+rng = random.Random()
+
+STORY_SENTENCES = [
+    "The wind carried the smell of rain across the valley.",
+    "Nobody in the village remembered who had built the old tower.",
+    '"We should not be here," she whispered, pulling her cloak tighter.',
+    "Somewhere below, a door slammed shut.",
+    "He counted the coins twice before he trusted the stranger.",
+    "By nightfall the lanterns along the harbour had all gone dark.",
+]
+
+
+def unit_classes():
+    return {cls.__name__: cls for cls in Unit.__subclasses__()}
+
+
+def sample_latency():
+    config = fake_app.config
+    mean = config['LATENCY_MEAN']
+    if config['LATENCY'] == 'uniform':
+        return rng.uniform(0, 2 * mean)
+    if config['LATENCY'] == 'lognormal':
+        sigma = config['LATENCY_SIGMA']
+        # Choose mu so that the distribution has the configured mean
+        return rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma) if mean > 0 else 0
+    return mean
+
+
+def fake_value(expected_type, unit_type, index):
+    if expected_type == bool:
+        return rng.random() < 0.5
+    if expected_type == float:
+        return round(rng.random(), 2)
+    if expected_type == list:
+        return [f"Fake {unit_type} Reference {rng.randint(1, 20)}" for _ in range(rng.randint(0, 2))]
+    return f"Some text about {unit_type} number {index}."
+
+
+def fake_features(unit_type, index=0, name=None):
+    feature_schema = unit_classes()[unit_type].feature_schema
+    features = {feature_name: fake_value(expected_type, unit_type, index)
+                for feature_name, expected_type in feature_schema.items()}
+    features['name'] = name or f"Fake {unit_type} {rng.randint(1, 10000)}"
+    return features
+
+
+def value_from_json_schema(schema):
+    '''
+    Produce a value that is valid for a (structured output) JSON schema.
+    '''
+    schema_type = schema.get('type')
+    if isinstance(schema_type, list):
+        schema_type = next((t for t in schema_type if t != 'null'), 'null')
+    if 'enum' in schema:
+        return rng.choice(schema['enum'])
+    if schema_type == 'object':
+        return {key: value_from_json_schema(value) for key, value in schema.get('properties', {}).items()}
+    if schema_type == 'array':
+        return [value_from_json_schema(schema.get('items', {})) for _ in range(rng.randint(0, 2))]
+    if schema_type == 'boolean':
+        return rng.random() < 0.5
+    if schema_type in ('number', 'integer'):
+        low, high = schema.get('minimum', 0), schema.get('maximum', 1)
+        return round(rng.uniform(low, high), 2) if schema_type == 'number' else rng.randint(int(low), int(high))
+    if schema_type == 'string':
+        return f"Fake text {rng.randint(1, 10000)}"
+    return None
+
+
+def fake_reply(body):
+    messages = body.get('messages', [])
+    text = '\n'.join(str(message.get('content', '')) for message in messages)
+
+    response_format = body.get('response_format') or {}
+    if response_format.get('type') == 'json_schema':
+        return json.dumps(value_from_json_schema(response_format['json_schema']['schema']))
+
+    if 'several new units' in text:
+        units = []
+        classes = list(unit_classes())
+        for match in re.finditer(r"- Unit (\d+): unit type (\w+)[^\n]*?(?:Its name must be '([^\n]*)'\.)?\n", text):
+            index, unit_type, name = int(match.group(1)), match.group(2), match.group(3)
+            if unit_type not in classes:
+                unit_type = rng.choice(classes)
+            units.append({'index': index, 'unit_type': unit_type, 'features': fake_features(unit_type, index, name)})
+        return json.dumps({'units': units})
+
+    match = re.search(r"features of the unit type '(\w+)'", text)
+    if match and match.group(1) in unit_classes():
+        return json.dumps(fake_features(match.group(1)))
+
+    if 'board adventure game' in text:
+        return json.dumps({
+            'setting_and_style': "A fake setting for load tests.",
+            'challenge_or_goal': "Find the fake treasure.",
+            'core_secrets': "The treasure was never real.",
+            'start_description': "The players meet at the inn.",
+            'chronology': "First the inn, then the cave.",
+            'locations': [
+                {'name': f"Fake Location {i}", 'description': "A place.", 'events': "Things happen.",
+                 'npcs': "Someone.", 'investigation': "A clue."} for i in range(3)
+            ],
+            'npcs': [{'name': f"Fake NPC {i}", 'description': "A person."} for i in range(3)],
+        })
+
+    return ' '.join(rng.choice(STORY_SENTENCES) for _ in range(40))
+
+
+def error_response(status, message, error_type):
+    return Response(json.dumps({'error': {'message': message, 'type': error_type, 'code': None}}),
+                    status=status, mimetype='application/json',
+                    headers={'retry-after': '1'} if status == 429 else {})
+
+
+@fake_app.route('/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    config = fake_app.config
+    body = request.get_json(force=True)
+    model = body.get('model', 'gpt-4o-mini')
+
+    roll = rng.random()
+    if roll < config['ERROR_429']:
+        return error_response(429, "Rate limit reached (fake).", 'rate_limit_exceeded')
+    roll -= config['ERROR_429']
+    if roll < config['ERROR_500']:
+        return error_response(500, "The server had an error (fake).", 'server_error')
+    roll -= config['ERROR_500']
+    if roll < config['ERROR_TIMEOUT']:
+        time.sleep(config['TIMEOUT_DELAY'])
+
+    time.sleep(sample_latency())
+    content = fake_reply(body)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    prompt_tokens = estimate_prompt_tokens(body.get('messages', []))
+    usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': estimate_tokens(content),
+             'total_tokens': prompt_tokens + estimate_tokens(content)}
+
+    if not body.get('stream'):
+        return {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': created,
+            'model': model,
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': usage,
+        }
+
+    include_usage = (body.get('stream_options') or {}).get('include_usage')
+
+    def generate():
+        def chunk(choices, chunk_usage=None):
+            data = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created,
+                    'model': model, 'choices': choices}
+            if chunk_usage:
+                data['usage'] = chunk_usage
+            return f"data: {json.dumps(data)}\n\n"
+
+        yield chunk([{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])
+        for token in re.findall(r'\S+\s*', content):
+            time.sleep(config['TOKEN_DELAY'])
+            yield chunk([{'index': 0, 'delta': {'content': token}, 'finish_reason': None}])
+        yield chunk([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        if include_usage:
+            yield chunk([], usage)
+        yield "data: [DONE]\n\n"
+
+    return Response(generate(), mimetype='text/event-stream')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', choices=['fixed', 'uniform', 'lognormal'], default='fixed')
+    parser.add_argument('--latency-mean', type=float, default=0.5)
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--token-delay', type=float, default=0.01)
+    parser.add_argument('--error-429', type=float, default=0.0)
+    parser.add_argument('--error-500', type=float, default=0.0)
+    parser.add_argument('--error-timeout', type=float, default=0.0)
+    parser.add_argument('--timeout-delay', type=float, default=600)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    fake_app.config.update(
+        LATENCY=args.latency,
+        LATENCY_MEAN=args.latency_mean,
+        LATENCY_SIGMA=args.latency_sigma,
+        TOKEN_DELAY=args.token_delay,
+        ERROR_429=args.error_429,
+        ERROR_500=args.error_500,
+        ERROR_TIMEOUT=args.error_timeout,
+        TIMEOUT_DELAY=args.timeout_delay,
+    )
+    if args.seed is not None:
+        rng.seed(args.seed)
+    fake_app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,119 @@
+# jobs.py
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from models import db, Job
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+# Jobs live in the worker pool of the process that submitted them, one that is
+# still unfinished after JOB_TIMEOUT seconds was lost (e.g. in a restart)
+JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', 900))
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 24 * 3600))  # Seconds finished jobs are kept
+JOB_CLEANUP_INTERVAL = int(os.environ.get('JOB_CLEANUP_INTERVAL', 600))  # Seconds between cleanups
+
+LOST_JOB_ERROR = "The job was interrupted, e.g. by a server restart. Please try again."
+
+job_handlers = {}
+executor = None
+_app = None
+_cleanup_lock = threading.Lock()
+_last_cleanup = 0.0
+
+
+def job_handler(kind):
+    '''
+    Register a function as the handler for jobs of the given kind.
+    The handler is called with the job payload as keyword arguments inside an
+    app context and must return something JSON serializable.
+    '''
+    def decorator(func):
+        job_handlers[kind] = func
+        return func
+    return decorator
+
+
+def init_jobs(app, max_workers=JOB_WORKERS):
+    global executor, _app
+    _app = app
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+    # job_wait.html stops polling once a job must have been lost
+    app.jinja_env.globals['job_timeout'] = JOB_TIMEOUT
+
+
+def submit_job(kind, user_id, **payload):
+    if kind not in job_handlers:
+        raise ValueError(f"Unknown job kind '{kind}'")
+
+    maybe_clean_up_jobs()
+    job = Job(id=uuid.uuid4().hex, user_id=user_id, kind=kind, status='queued', payload=payload)
+    db.session.add(job)
+    db.session.commit()
+
+    executor.submit(_run_job, job.id)
+    return job
+
+
+def _run_job(job_id):
+    with _app.app_context():
+        job = db.session.get(Job, job_id)
+        if job is None:
+            return
+        job.status = 'running'
+        db.session.commit()
+
+        try:
+            result = job_handlers[job.kind](**job.payload)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Job {job.id} ({job.kind}) failed: {e}")
+            job.status = 'failed'
+            job.error = str(e)
+        else:
+            job.status = 'done'
+            job.result = result
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+
+def fail_lost_job(job):
+    '''
+    Mark job failed if it is unfinished after JOB_TIMEOUT, nothing will
+    finish it any more. Returns job.
+    '''
+    if not job.finished and job.created_at < datetime.utcnow() - timedelta(seconds=JOB_TIMEOUT):
+        job.status = 'failed'
+        job.error = LOST_JOB_ERROR
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+    return job
+
+
+def clean_up_jobs():
+    '''
+    Fail the lost jobs and delete the ones that finished more than
+    JOB_RETENTION seconds ago, with their payloads and results.
+    '''
+    now = datetime.utcnow()
+    lost = Job.query.filter(Job.status.in_(('queued', 'running')),
+                            Job.created_at < now - timedelta(seconds=JOB_TIMEOUT)) \
+        .update({'status': 'failed', 'error': LOST_JOB_ERROR, 'finished_at': now}, synchronize_session=False)
+    deleted = Job.query.filter(Job.status.in_(('done', 'failed')),
+                               Job.finished_at < now - timedelta(seconds=JOB_RETENTION)) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    if lost or deleted:
+        print(f"Job cleanup: {lost} lost jobs failed, {deleted} old jobs deleted")
+
+
+def maybe_clean_up_jobs():
+    # At most once per JOB_CLEANUP_INTERVAL in each process
+    global _last_cleanup
+    with _cleanup_lock:
+        if time.time() - _last_cleanup < JOB_CLEANUP_INTERVAL:
+            return
+        _last_cleanup = time.time()
+    clean_up_jobs()
@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from storage import SQLITE_BUSY_TIMEOUT, SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS
+
+# Next to the app database in the instance folder, which is not part of the repository
+LLM_CACHE_PATH = os.environ.get(
+    'LLM_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'llm_cache.db'))
+LLM_CACHE_MEMORY_ENTRIES = int(os.environ.get('LLM_CACHE_MEMORY_ENTRIES', 256))
+LLM_CACHE_DISK_ENTRIES = int(os.environ.get('LLM_CACHE_DISK_ENTRIES', 5000))
+LLM_CACHE_TTL = int(os.environ.get('LLM_CACHE_TTL', 7 * 24 * 3600))  # Seconds
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', '1') != '0'
+
+
+def normalize_messages(messages):
+    '''
+    Reduce messages to the parts that influence the completion, so that
+    irrelevant differences (extra keys, surrounding whitespace) share a cache entry.
+    '''
+    normalized = []
+    for message in messages:
+        content = message.get('content') or ''
+        if isinstance(content, str):
+            content = '\n'.join(line.rstrip() for line in content.strip().splitlines())
+        normalized.append({'role': message.get('role'), 'content': content})
+    return normalized
+
+
+def make_cache_key(model, messages, **params):
+    payload = {'model': model, 'messages': normalize_messages(messages)}
+    # Only parameters that change the reply become part of the key
+    payload.update({key: value for key, value in params.items() if value is not None})
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    '''
+    Two tier cache for LLM replies: an in-process LRU in front of a SQLite file
+    that is shared by all worker processes and survives restarts.
+    '''
+
+    def __init__(self, path=LLM_CACHE_PATH, memory_entries=LLM_CACHE_MEMORY_ENTRIES,
+                 disk_entries=LLM_CACHE_DISK_ENTRIES, ttl=LLM_CACHE_TTL):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()  # key -> (created_at, value)
+        self._lock = threading.Lock()
+        self._table_ready = False
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if not self._table_ready and os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT / 1000)
+        # Same settings as the app database: readers are not blocked by the write of a disk hit
+        conn.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        if not self._table_ready:
+            # The journal mode is stored in the file, setting it once per process is enough
+            conn.execute(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache ('
+                ' key TEXT PRIMARY KEY,'
+                ' value TEXT NOT NULL,'
+                ' created_at REAL NOT NULL,'
+                ' accessed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed_at ON llm_cache (accessed_at)')
+            # Lock table for coalescing identical calls across worker processes, see singleflight.py
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_inflight ('
+                ' key TEXT PRIMARY KEY,'
+                ' owner TEXT NOT NULL,'
+                ' expires_at REAL NOT NULL)'
+            )
+            conn.commit()
+            self._table_ready = True
+        return conn
+
+    def _remember(self, key, created_at, value):
+        # Caller holds self._lock
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key, count=True):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self._memory.move_to_end(key)
+                if count:
+                    self.hits += 1
+                    self.memory_hits += 1
+                return entry[1]
+            if entry:
+                del self._memory[key]
+
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute('SELECT value, created_at FROM llm_cache WHERE key = ?', (key,)).fetchone()
+                if row and now - row[1] < self.ttl:
+                    conn.execute('UPDATE llm_cache SET accessed_at = ? WHERE key = ?', (now, key))
+                    conn.commit()
+                elif row:
+                    conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                    conn.commit()
+                    row = None
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"LLM cache read failed: {e}")
+            row = None
+
+        with self._lock:
+            if row:
+                self._remember(key, row[1], row[0])
+                if count:
+                    self.hits += 1
+                    self.disk_hits += 1
+                return row[0]
+            if count:
+                self.misses += 1
+        return None
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+        try:
+            conn = self._connect()
+            try:
+                conn.execute(
+                    'INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                    (key, value, now, now)
+                )
+                self._evict(conn, now)
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"LLM cache write failed: {e}")
+
+    def _evict(self, conn, now):
+        # Drop expired entries, then the least recently used ones above the size limit
+        conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl,))
+        conn.execute(
+            'DELETE FROM llm_cache WHERE key IN ('
+            ' SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+            (self.disk_entries,)
+        )
+
+    def try_lock(self, key, owner, ttl):
+        '''
+        Try to become the process that computes key. Returns False while another
+        owner holds an unexpired lock.
+        '''
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM llm_inflight WHERE key = ? AND expires_at < ?', (key, now))
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO llm_inflight (key, owner, expires_at) VALUES (?, ?, ?)',
+                (key, owner, now + ttl)
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def is_locked(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT 1 FROM llm_inflight WHERE key = ? AND expires_at >= ?',
+                               (key, time.time())).fetchone()
+            return row is not None
+        finally:
+            conn.close()
+
+    def unlock(self, key, owner):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM llm_inflight WHERE key = ? AND owner = ?', (key, owner))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM llm_cache')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+            }
+
+
+llm_cache = LLMCache()
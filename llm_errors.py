@@ -0,0 +1,36 @@
+# llm_errors.py
+import math
+
+
+class LLMError(Exception):
+    '''
+    Base class for errors of the language model backend. The message is meant
+    to be shown to the user.
+    '''
+
+
+class LLMTimeoutError(LLMError):
+    pass
+
+
+class LLMRateLimitError(LLMError):
+    pass
+
+
+class LLMUnavailableError(LLMError):
+    pass
+
+
+class LLMRequestError(LLMError):
+    pass
+
+
+class LLMBusyError(LLMError):
+    '''
+    Raised when a call to the language model is refused by the limiter.
+    retry_after is the number of seconds after which a retry makes sense.
+    '''
+
+    def __init__(self, retry_after):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"We are busy right now, please retry in {self.retry_after} s.")
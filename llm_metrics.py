@@ -0,0 +1,124 @@
+# llm_metrics.py
+import threading
+
+# Latency buckets in seconds, LLM calls take anywhere from milliseconds (cache) to minutes
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+# US$ per million (prompt, completion) tokens
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'o1-mini': (3.00, 12.00),
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class LLMMetrics:
+    '''
+    In-process collection of LLM call statistics, labelled by route (the part
+    of the app that made the call) and model.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latency = {}  # (route, model, cache) -> Histogram
+            self.first_token_latency = {}  # (route, model) -> Histogram, streamed calls only
+            self.prompt_tokens = {}  # (route, model) -> Histogram
+            self.completion_tokens = {}  # (route, model) -> Histogram
+            self.counters = {}  # (name, labels) -> value
+
+    def _inc(self, name, labels, amount=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def record_call(self, route, model, latency, prompt_tokens=0, completion_tokens=0, retries=0,
+                    cache_hit=False, error=None):
+        cache = 'hit' if cache_hit else 'miss'
+        with self._lock:
+            self.latency.setdefault((route, model, cache), Histogram(LATENCY_BUCKETS)).observe(latency)
+            self._inc('llm_requests_total', (('route', route), ('model', model), ('cache', cache)))
+            if retries:
+                self._inc('llm_retries_total', (('route', route), ('model', model)), retries)
+            if error:
+                self._inc('llm_errors_total', (('route', route), ('model', model), ('error', error)))
+            if cache_hit or error:
+                return
+            self.prompt_tokens.setdefault((route, model), Histogram(TOKEN_BUCKETS)).observe(prompt_tokens)
+            self.completion_tokens.setdefault((route, model), Histogram(TOKEN_BUCKETS)).observe(completion_tokens)
+            prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+            cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+            self._inc('llm_cost_dollars_total', (('route', route), ('model', model)), cost)
+
+    def observe_first_token(self, route, model, latency):
+        with self._lock:
+            self.first_token_latency.setdefault((route, model), Histogram(LATENCY_BUCKETS)).observe(latency)
+
+    def inc(self, name, **labels):
+        with self._lock:
+            self._inc(name, tuple(sorted(labels.items())))
+
+    def render(self, extra_gauges=None):
+        '''
+        Render all metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        with self._lock:
+            self._render_histograms(lines, 'llm_request_duration_seconds', self.latency, ('route', 'model', 'cache'))
+            self._render_histograms(lines, 'llm_time_to_first_token_seconds', self.first_token_latency, ('route', 'model'))
+            self._render_histograms(lines, 'llm_prompt_tokens', self.prompt_tokens, ('route', 'model'))
+            self._render_histograms(lines, 'llm_completion_tokens', self.completion_tokens, ('route', 'model'))
+            seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name, value in sorted((extra_gauges or {}).items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_histograms(lines, name, histograms, label_names):
+        if not histograms:
+            return
+        lines.append(f"# TYPE {name} histogram")
+        for label_values, histogram in sorted(histograms.items()):
+            labels = tuple(zip(label_names, label_values))
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+llm_metrics = LLMMetrics()
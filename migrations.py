@@ -0,0 +1,144 @@
+# migrations.py
+'''
+Schema migrations. A new database gets the current schema straight from the
+models; an existing one is upgraded step by step. The schema_version table
+records which steps were applied. Run them with
+
+    flask upgrade-db
+
+(python app.py does the same before it starts). Add a step by appending a
+function decorated with @migration(next version, description) below; never
+change a step that was released.
+'''
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+
+from models import db, Job, Story, Unit, UnitReference, normalize_name, replace_unit_references
+
+schema_meta = MetaData()
+schema_version = Table(
+    'schema_version', schema_meta,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(255), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+MIGRATIONS = []  # (version, description, function), in order
+
+
+def migration(version, description):
+    def decorator(function):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version, "Migrations must be added in order"
+        MIGRATIONS.append((version, description, function))
+        return function
+    return decorator
+
+
+def _add_column(connection, table, column_sql):
+    name = column_sql.split()[0]
+    if name not in {column['name'] for column in inspect(connection).get_columns(table)}:
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column_sql}'))
+
+
+@migration(1, "Job table for background work")
+def create_job_table(connection):
+    Job.__table__.create(connection, checkfirst=True)
+
+
+@migration(2, "Story revision and stored full text")
+def add_story_revision(connection):
+    _add_column(connection, 'story', 'revision INTEGER NOT NULL DEFAULT 1')
+    _add_column(connection, 'story', 'full_text TEXT')
+    _add_column(connection, 'story', 'full_text_revision INTEGER')
+
+
+@migration(3, "Normalized unit names, unique per story")
+def add_unit_normalized_name(connection):
+    _add_column(connection, 'unit', 'normalized_name VARCHAR(150)')
+    unit_table = Unit.__table__
+    taken = set()
+    for row in connection.execute(select(unit_table.c.id, unit_table.c.story_id, unit_table.c.features)
+                                  .order_by(unit_table.c.id)):
+        normalized_name = normalize_name((row.features or {}).get('name')) or None
+        if normalized_name and (row.story_id, normalized_name) in taken:
+            # The old name check was case sensitive in places, the older unit keeps the name
+            print(f"Unit {row.id} has the same name as another unit of story {row.story_id}, "
+                  f"it is left out of name lookups until it is renamed")
+            normalized_name = None
+        taken.add((row.story_id, normalized_name))
+        connection.execute(unit_table.update().where(unit_table.c.id == row.id)
+                           .values(normalized_name=normalized_name))
+    # A unique index does what the model's unique constraint does, and SQLite can add it to an existing table
+    connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS uq_unit_story_normalized_name '
+                            'ON unit (story_id, normalized_name)'))
+
+
+@migration(4, "unit_reference table instead of the pickled undefined_names")
+def create_unit_reference_table(connection):
+    UnitReference.__table__.create(connection, checkfirst=True)
+    unit_table = Unit.__table__
+    # Rows have the id, story_id and features attributes replace_unit_references reads
+    for row in connection.execute(select(unit_table.c.id, unit_table.c.story_id, unit_table.c.features)).all():
+        replace_unit_references(connection, row)
+    # story.undefined_names stays in old databases but is no longer read
+
+
+@migration(5, "Unit revision for the cached unit texts")
+def add_unit_revision(connection):
+    _add_column(connection, 'unit', 'revision INTEGER NOT NULL DEFAULT 1')
+
+
+@migration(6, "Story board game revision and time of the last change")
+def add_story_updated_at(connection):
+    _add_column(connection, 'story', 'board_game_revision INTEGER NOT NULL DEFAULT 1')
+    # DATETIME on SQLite, TIMESTAMP on Postgres
+    _add_column(connection, 'story', f'updated_at {DateTime().compile(dialect=connection.dialect)}')
+    story_table = Story.__table__
+    connection.execute(story_table.update().where(story_table.c.updated_at.is_(None))
+                       .values(updated_at=datetime.utcnow()))
+
+
+@migration(7, "Story full text version, the story PDF is kept per version")
+def add_story_full_text_version(connection):
+    _add_column(connection, 'story', 'full_text_version INTEGER NOT NULL DEFAULT 0')
+
+
+def current_version(connection):
+    if not inspect(connection).has_table('schema_version'):
+        return None
+    return connection.execute(select(db.func.max(schema_version.c.version))).scalar() or 0
+
+
+def _record(connection, version, description):
+    connection.execute(schema_version.insert().values(version=version, description=description,
+                                                      applied_at=datetime.utcnow()))
+
+
+def upgrade(engine):
+    '''
+    Bring the database behind engine to the current schema. Returns the
+    descriptions of the steps that were applied.
+    '''
+    applied = []
+    with engine.begin() as connection:
+        version = current_version(connection)
+        if version is None:
+            schema_meta.create_all(connection)
+            if not inspect(connection).has_table(Story.__tablename__):
+                # A new database: create everything, there is nothing to upgrade
+                db.metadata.create_all(connection)
+                for step, description, _ in MIGRATIONS:
+                    _record(connection, step, description)
+                return [f"Created the schema at version {MIGRATIONS[-1][0]}"]
+            version = 0  # A database from before migrations existed
+
+    # Every step in its own transaction, so a failed step leaves the ones before it applied
+    for step, description, function in MIGRATIONS:
+        if step <= version:
+            continue
+        with engine.begin() as connection:
+            function(connection)
+            _record(connection, step, description)
+        applied.append(f"Applied {step}: {description}")
+    return applied
@@ -1,19 +1,50 @@
 # models.py
+import json
 import os
+import threading
+from datetime import datetime
 
+from cachetools import LRUCache
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
 from fpdf import FPDF
+from sqlalchemy import event, inspect, select
 from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy.ext.mutable import MutableList
-from sqlalchemy.types import PickleType
-from sqlalchemy.orm import validates
+from sqlalchemy.orm import Session, validates
 from werkzeug.utils import secure_filename
 
 from openai_client import call_openai
+from storage import JSONType
 
 db = SQLAlchemy()
 
+PDF_FOLDER = os.environ.get('PDF_FOLDER', 'pdf_files')
+
+# Length of the columns that hold unit names and the names in list features
+NAME_MAX_LENGTH = 150
+
+# Rendered text of units (per unit revision) and stories (per story revision), see Story.to_text_list
+UNIT_TEXT_CACHE_SIZE = int(os.environ.get('UNIT_TEXT_CACHE_SIZE', 20000))
+STORY_TEXT_CACHE_SIZE = int(os.environ.get('STORY_TEXT_CACHE_SIZE', 256))
+# Units read from the database at a time by Story.iter_json
+JSON_EXPORT_BATCH_SIZE = int(os.environ.get('JSON_EXPORT_BATCH_SIZE', 200))
+unit_text_cache = LRUCache(maxsize=UNIT_TEXT_CACHE_SIZE)  # unit id -> (revision, references, lines, text)
+story_text_cache = LRUCache(maxsize=STORY_TEXT_CACHE_SIZE)  # story id -> (revision, text)
+text_cache_lock = threading.Lock()
+
+
+def reference_stamp(unit):
+    # What the text of a unit that refers to unit depends on
+    return (unit.id, unit.revision) if unit is not None else None
+
+
+def normalize_name(name):
+    '''
+    The form of a unit name used for lookups and the duplicate check:
+    case and runs of whitespace do not make two names different.
+    '''
+    return ' '.join((name or '').split()).lower()
+
 
 class User(db.Model, UserMixin):
     __tablename__ = 'user'
@@ -23,6 +54,35 @@ class User(db.Model, UserMixin):
     stories = db.relationship('Story', backref='user', lazy=True)
 
 
+class Job(db.Model):
+    '''
+    A slow (LLM bound) piece of work that runs on the background worker pool.
+    '''
+    __tablename__ = 'job'
+
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    payload = db.Column(MutableDict.as_mutable(JSONType), default={})
+    result = db.Column(JSONType)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'error': self.error,
+        }
+
+
 class Story(db.Model):
     __tablename__ = 'story'
 
@@ -30,13 +90,22 @@ class Story(db.Model):
     name = db.Column(db.String(150), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     units = db.relationship('Unit', backref='story', lazy=True)
-    undefined_names = db.Column(MutableList.as_mutable(PickleType), default=[])
     setting_and_style = db.Column(db.Text, nullable=False)
     main_challenge = db.Column(db.Text, nullable=False)
-    board_game_data = db.Column(MutableDict.as_mutable(db.JSON), default={
+    board_game_data = db.Column(MutableDict.as_mutable(JSONType), default={
             'texts': {},
             'images': {}
         })
+    # Bumped on every change of the story or its units, see bump_story_revisions
+    revision = db.Column(db.Integer, nullable=False, default=1)
+    full_text = db.Column(db.Text)  # Last generated story prose
+    full_text_revision = db.Column(db.Integer)  # The revision full_text was written for
+    # Bumped whenever full_text is written, a new version can be written within a revision
+    full_text_version = db.Column(db.Integer, nullable=False, default=0)
+    # Bumped when board_game_data changes, the board game PDFs are kept per board game revision
+    board_game_revision = db.Column(db.Integer, nullable=False, default=1)
+    # Last change of the story, its units or its board game, the Last-Modified of the exports
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __getitem__(self, unit_name):
         return self.get_unit_by_name(unit_name)
@@ -52,72 +121,221 @@ class Story(db.Model):
         db.session.add(unit)
         db.session.commit()
 
+    @property
+    def undefined_names(self):
+        '''
+        The names that units of this story refer to but no unit has, i.e. the
+        unresolved rows of the unit_reference table.
+        '''
+        if self.id is None:
+            return []
+        rows = db.session.query(db.func.min(UnitReference.target_name)).filter(
+            UnitReference.story_id == self.id,
+            UnitReference.target_unit_id.is_(None)
+        ).group_by(UnitReference.target_normalized).order_by(UnitReference.target_normalized)
+        return [name for (name,) in rows]
+
     def get_unit_by_name(self, name):
-        return next((unit for unit in self.units if unit.name.lower() == name.lower()), None)
+        normalized_name = normalize_name(name)
+        if not normalized_name:
+            return None
+        # Uses the unique (story_id, normalized_name) index instead of loading all units
+        return Unit.query.filter_by(story_id=self.id, normalized_name=normalized_name).first()
+
+    def get_units_by_names(self, names):
+        '''
+        Look up many names at once. Returns a dict of normalized name to unit,
+        names without a unit are left out.
+        '''
+        normalized_names = list({normalize_name(name) for name in names} - {''})
+        units_by_name = {}
+        # Stay below SQLite's limit for query parameters
+        for start in range(0, len(normalized_names), 500):
+            chunk = normalized_names[start:start + 500]
+            for unit in Unit.query.filter(Unit.story_id == self.id, Unit.normalized_name.in_(chunk)):
+                units_by_name[unit.normalized_name] = unit
+        return units_by_name
 
     def to_json(self):
         '''
         Serialize the story and its units into a JSON-friendly dictionary.
         '''
-        story_dict = {
+        story_dict = self.to_json_header()
+        story_dict['units'] = [unit.to_json() for unit in self.units]
+        return story_dict
+
+    def to_json_header(self):
+        return {
             'id': self.id,
             'name': self.name,
             'user_id': self.user_id,
             'undefined_names': self.undefined_names,
             'setting_and_style': self.setting_and_style,
             'main_challenge': self.main_challenge,
-            'units': [unit.to_json() for unit in self.units]
         }
-        return story_dict
+
+    def iter_json(self, indent=4, batch_size=JSON_EXPORT_BATCH_SIZE):
+        '''
+        Yield to_json() serialized like json.dumps(self.to_json(), indent=indent),
+        one piece per batch of units (indent=None gives the most compact JSON).
+        The units are read with a batched cursor as plain rows, not loaded into
+        the session, so memory use does not grow with the story.
+        '''
+        separators = (',', ':') if indent is None else None
+        # Line breaks before the units and before the list's closing bracket
+        unit_newline = '' if indent is None else '\n' + ' ' * 2 * indent
+        end_newline = '' if indent is None else '\n' + ' ' * indent
+
+        story_dict = self.to_json_header()
+        story_dict['units'] = []
+        # Everything up to the (empty) units list, 'units' is the last key
+        head = json.dumps(story_dict, indent=indent, separators=separators)
+        units_at = head.rindex('[]')
+        yield head[:units_at] + '['
+
+        unit_table = Unit.__table__
+        rows = db.session.execute(
+            select(unit_table.c.id, unit_table.c.unit_type, unit_table.c.features)
+            .where(unit_table.c.story_id == self.id)
+            .order_by(unit_table.c.id)
+            .execution_options(yield_per=batch_size)
+        )
+        first = True
+        for batch in rows.partitions():
+            pieces = []
+            for row in batch:
+                unit_json = json.dumps({'id': row.id, 'unit_type': row.unit_type, 'features': row.features},
+                                       indent=indent, separators=separators)
+                pieces.append(('' if first else ',') + unit_newline + unit_json.replace('\n', unit_newline))
+                first = False
+            yield ''.join(pieces)
+        yield ('' if first else end_newline) + ']' + head[units_at + 2:]
 
     def to_text_list(self):
+        '''
+        The story as text for the prompts. Cached per revision; after a change
+        only the units that changed, or whose referenced units changed, are
+        rendered again and the rest is put together from the cached texts.
+        '''
+        # Unflushed changes are not counted in the revisions yet
+        cacheable = self.id is not None and not (db.session.new or db.session.dirty or db.session.deleted)
+        if cacheable:
+            with text_cache_lock:
+                entry = story_text_cache.get(self.id)
+            if entry is not None and entry[0] == self.revision:
+                return entry[1]
+
+        revision = self.revision
+        unit_dict = {normalize_name(unit.name): unit for unit in self.units}
+        parts = ["\n".join(self.header_text_lines())]
+        parts.extend(self.rendered_unit(unit, unit_dict)[3] for unit in self.units)
+        text = "\n".join(parts)
+
+        if cacheable:
+            with text_cache_lock:
+                story_text_cache[self.id] = (revision, text)
+        return text
+
+    def header_text_lines(self):
         lines = []
         lines.append(f"Story Name: {self.name}")
         lines.append(f"Setting and Style: {self.setting_and_style}")
         lines.append(f"Main Challenge: {self.main_challenge}")
         lines.append("")  # Blank line for separation
+        return lines
+
+    def unit_text_lines(self, unit, unit_dict):
+        '''
+        Render one unit for to_text_list. unit_dict maps normalized unit names to
+        units and is used to describe the units this one refers to.
+        '''
+        return self.rendered_unit(unit, unit_dict)[2]
 
-        unit_dict = {unit.name: unit for unit in self.units}
-
-        for unit in self.units:
-            unit_name = unit.name or ''
-            unit_header = f"{unit.unit_type}: {unit_name}"
-            lines.append(unit_header)
-
-            for feature_name, value in unit.features.items():
-                value_str = ''
-                if isinstance(value, list):
-                    related_units = []
-                    for item in value:
-                        if isinstance(item, str):
-                            related_unit = unit_dict.get(item)
-                            if related_unit:
-                                related_unit_name = related_unit.name or item
-                                related_units.append(f"{related_unit.unit_type}: {related_unit_name}")
-                            elif item in self.undefined_names:
-                                related_units.append(f"Unset name: {item}")
-                            else:
-                                related_units.append(f"Really undefined: {item}")
+    def rendered_unit(self, unit, unit_dict):
+        '''
+        The cache entry (revision, references, lines, text) of unit, rendered
+        again if the unit or one of the units it refers to has a new revision
+        or a referenced name now belongs to a different unit (or to none).
+        '''
+        cacheable = unit.id is not None and not inspect(unit).modified
+        if cacheable:
+            with text_cache_lock:
+                entry = unit_text_cache.get(unit.id)
+            if entry is not None and entry[0] == unit.revision and all(
+                    reference_stamp(unit_dict.get(name)) == stamp for name, stamp in entry[1]):
+                return entry
+
+        revision = unit.revision
+        lines, looked_up = self.render_unit_text_lines(unit, unit_dict)
+        references = tuple((name, reference_stamp(unit_dict.get(name))) for name in looked_up)
+        entry = (revision, references, tuple(lines), "\n".join(lines))
+        if cacheable:
+            with text_cache_lock:
+                unit_text_cache[unit.id] = entry
+        return entry
+
+    def render_unit_text_lines(self, unit, unit_dict):
+        '''
+        The lines of unit_text_lines and the set of normalized names looked up in
+        unit_dict, names are matched the way the unit_reference table matches them.
+        '''
+        lines = []
+        looked_up = set()
+        unit_name = unit.name or ''
+        unit_header = f"{unit.unit_type}: {unit_name}"
+        lines.append(unit_header)
+
+        for feature_name, value in unit.features.items():
+            value_str = ''
+            if isinstance(value, list):
+                related_units = []
+                for item in value:
+                    if isinstance(item, str):
+                        normalized_item = normalize_name(item)
+                        looked_up.add(normalized_item)
+                        related_unit = unit_dict.get(normalized_item)
+                        if related_unit:
+                            related_unit_name = related_unit.name or item
+                            related_units.append(f"{related_unit.unit_type}: {related_unit_name}")
                         else:
-                            related_units.append(str(item))
-                    value_str = '; '.join(related_units)
-                elif isinstance(value, str):
-                    value_str = value
-                elif isinstance(value, bool):
-                    value_str = 'Yes' if value else 'No'
-                elif isinstance(value, float):
-                    value_str = str(round(value, 2))
-                else:
-                    value_str = str(value)
-                lines.append(f"  {feature_name}: {value_str}")
+                            # Every name in a list feature without a unit is an undefined name
+                            related_units.append(f"Unset name: {item}")
+                    else:
+                        related_units.append(str(item))
+                value_str = '; '.join(related_units)
+            elif isinstance(value, str):
+                value_str = value
+            elif isinstance(value, bool):
+                value_str = 'Yes' if value else 'No'
+            elif isinstance(value, float):
+                value_str = str(round(value, 2))
+            else:
+                value_str = str(value)
+            lines.append(f"  {feature_name}: {value_str}")
 
-            lines.append("")  # Blank line between units
+        lines.append("")  # Blank line between units
+        return lines, looked_up
 
-        return "\n".join(lines)
+    def pdf_path(self):
+        '''
+        Where the PDF of the current revision and full text version is kept,
+        see full_story_job in app.py.
+        '''
+        return os.path.join(PDF_FOLDER, f'story_{self.id}_r{self.revision}_t{self.full_text_version}.pdf')
 
-    def to_pdf(self, filename='story.pdf'):
+    def to_pdf(self, filename=None, regenerate=False):
+        '''
+        Write the story as PDF to filename, by default to pdf_path() of the
+        text that ends up in it.
+        '''
         from fpdf import FPDF
-        story_text = self.to_full_text()
+        # The stored text is used unless a new version is asked for
+        story_text = None if regenerate else self.get_stored_full_text()
+        if not story_text:
+            story_text = self.to_full_text(use_cache=not regenerate)
+            db.session.flush()  # Writes the new full_text_version, which pdf_path reads
+        if filename is None:
+            filename = self.pdf_path()
         pdf = FPDF()
         pdf.add_page()
         pdf.set_auto_page_break(auto=True, margin=15)
@@ -130,8 +348,13 @@ class Story(db.Model):
         pdf.add_font('DejaVu', '', 'DejaVuSansCondensed.ttf', uni=True)
         pdf.set_font('DejaVu', '', 12)
         pdf.multi_cell(0, 10, story_text)
-        pdf.output(secure_filename(filename))
+        output_dir = os.path.dirname(filename)
+        output_path = os.path.join(output_dir, secure_filename(os.path.basename(filename)))
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        pdf.output(output_path)
         print('PDF created successfully')
+        return output_path
 
     def create_full_story_prompt(self):
         '''
@@ -152,31 +375,63 @@ Ensure that the story flows naturally and includes dialogue, descriptions, and c
 """
         return prompt
 
-    def to_full_text(self):
+    def create_full_story_messages(self, prompt=None):
+        if prompt is None:
+            prompt = self.create_full_story_prompt()
+        messages = [
+            {
+                "role": "system",
+                "content": "You are a talented author crafting immersive and engaging stories."
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+        return messages
+
+    def to_full_text(self, use_cache=True):
         '''
         Generate the full text of the story using OpenAI API.
+        use_cache=False writes a new version instead of reusing the LLM cache.
         '''
-        # Prepare the prompt
-        prompt = self.create_full_story_prompt()
-
-        try:
-            messages = [
-                {
-                    "role": "system",
-                    "content": "You are a talented author crafting immersive and engaging stories."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-            full_story = call_openai(messages, model="gpt-4o")  # TODO: use "o1-mini" instead, it is much better
-
-            return full_story
-        except Exception as e:
-            # Handle exceptions, perhaps log the error
-            print(f"Error generating full story: {e}")
+        # The text belongs to the revision it was started for, even if the story changes meanwhile
+        revision = self.revision
+        messages = self.create_full_story_messages()
+
+        # LLMErrors are passed on, the caller decides how to tell the user
+        full_story = call_openai(messages, model="gpt-4o", use_cache=use_cache, route='full_story', user_id=self.user_id)  # TODO: use "o1-mini" instead, it is much better
+        self.store_full_text(full_story, revision)
+
+        return full_story
+
+    def stream_full_text(self, use_cache=True):
+        '''
+        Generate the full text of the story piece by piece. Once the stream has
+        finished the assembled text is stored, so to_pdf does not have to ask again.
+        '''
+        revision = self.revision
+        messages = self.create_full_story_messages()
+        parts = []
+        for part in call_openai(messages, model="gpt-4o", use_cache=use_cache, stream=True, route='full_story',
+                                user_id=self.user_id):
+            parts.append(part)
+            yield part
+        self.store_full_text(''.join(parts), revision)
+
+    def store_full_text(self, full_text, revision):
+        self.full_text = full_text
+        self.full_text_revision = revision
+        # Incremented in SQL like the revision, the PDF and its ETag are keyed by it
+        self.full_text_version = Story.full_text_version + 1
+
+    def get_stored_full_text(self):
+        '''
+        Return the stored full text if it was written for the current revision.
+        '''
+        if not self.full_text or self.full_text_revision != self.revision:
             return None
+        return self.full_text
 
     def create_board_game_prompt(self):  # TODO: Redo this prompt, it is not good.
         prompt = f"""
@@ -434,7 +689,11 @@ class Unit(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     unit_type = db.Column(db.String(50))
     story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False)
-    features = db.Column(MutableDict.as_mutable(db.JSON))  # For mutable JSON support
+    features = db.Column(MutableDict.as_mutable(JSONType))  # For mutable JSON support
+    # normalize_name(name), kept up to date by sync_normalized_names
+    normalized_name = db.Column(db.String(NAME_MAX_LENGTH))
+    # Bumped on every change of the unit, see bump_unit_revisions
+    revision = db.Column(db.Integer, nullable=False, default=1)
 
     base_feature_schema = {'name': str}  # Add this to fix the AttributeError
 
@@ -442,6 +701,10 @@ class Unit(db.Model):
         'polymorphic_identity': 'unit',
         'polymorphic_on': unit_type
     }
+    __table_args__ = (
+        # Unit names are unique within a story, and this is the index get_unit_by_name uses
+        db.UniqueConstraint('story_id', 'normalized_name', name='uq_unit_story_normalized_name'),
+    )
 
     @property
     def name(self):
@@ -468,6 +731,249 @@ class Unit(db.Model):
         }
         return unit_dict
 
+# Story columns that only hold things generated from the story, changing them is no new revision
+DERIVED_STORY_COLUMNS = {'revision', 'full_text', 'full_text_revision', 'full_text_version', 'board_game_data',
+                         'board_game_revision', 'updated_at'}
+
+
+@event.listens_for(Session, 'before_flush')
+def bump_story_revisions(session, flush_context, instances):
+    '''
+    Count a new revision for every story that is changed in this flush,
+    directly or through one of its units. Generated content (full text,
+    PDFs) is stored per revision, so any write makes it stale. The board
+    game has its own revision, it is edited separately from the story.
+    '''
+    now = datetime.utcnow()
+    stories = {}
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Unit):
+            if obj in session.dirty and not session.is_modified(obj):
+                continue
+            story = obj.story if obj.story is not None else session.get(Story, obj.story_id)
+            if story is not None:
+                stories[id(story)] = story
+        elif isinstance(obj, Story) and obj in session.dirty:
+            state = inspect(obj)
+            if any(attr.history.has_changes() for attr in state.attrs if attr.key not in DERIVED_STORY_COLUMNS):
+                stories[id(obj)] = obj
+            if state.attrs.board_game_data.history.has_changes():
+                obj.board_game_revision = Story.board_game_revision + 1
+                obj.updated_at = now
+
+    # One transaction (e.g. a save that flushes several times) is one revision
+    revised = session.info.setdefault('revised_story_ids', set())
+    for story in stories.values():
+        if story in session.new or story in session.deleted or story.id in revised:
+            continue
+        revised.add(story.id)
+        # Incremented in SQL, so concurrent writers cannot both end up at the same revision
+        story.revision = Story.revision + 1
+        story.updated_at = now
+
+
+@event.listens_for(Session, 'before_flush')
+def bump_unit_revisions(session, flush_context, instances):
+    # The rendered text of a unit is cached per revision, see Story.rendered_unit
+    for obj in list(session.dirty):
+        if isinstance(obj, Unit) and session.is_modified(obj):
+            obj.revision = Unit.revision + 1
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def forget_revised_stories(session):
+    session.info.pop('revised_story_ids', None)
+
+
+@event.listens_for(Session, 'before_flush')
+def sync_normalized_names(session, flush_context, instances):
+    # The name lives in the features JSON, which is mostly changed in place
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Unit) and obj.features is not None:
+            normalized_name = normalize_name(obj.features.get('name')) or None
+            if obj.normalized_name != normalized_name:
+                obj.normalized_name = normalized_name
+
+
+class UnitReference(db.Model):
+    '''
+    One name in a list feature of a unit. target_unit_id points to the unit
+    of that name while one exists; the rows without it are the story's
+    undefined names. Kept up to date by sync_unit_references.
+    '''
+    __tablename__ = 'unit_reference'
+    id = db.Column(db.Integer, primary_key=True)
+    story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False)
+    source_unit_id = db.Column(db.Integer, db.ForeignKey('unit.id', ondelete='CASCADE'), nullable=False, index=True)
+    feature = db.Column(db.String(255), nullable=False)
+    target_name = db.Column(db.String(NAME_MAX_LENGTH), nullable=False)  # As written in the feature
+    target_normalized = db.Column(db.String(NAME_MAX_LENGTH), nullable=False)  # normalize_name(target_name)
+    target_unit_id = db.Column(db.Integer, db.ForeignKey('unit.id', ondelete='SET NULL'), index=True)
+
+    __table_args__ = (
+        # "Who refers to this name?" and the undefined names of a story
+        db.Index('ix_unit_reference_story_target', 'story_id', 'target_normalized'),
+    )
+
+
+def unit_reference_names(unit):
+    '''
+    The (feature, name) pairs of the names in unit's list features. Items
+    longer than a unit name can be (e.g. whole sentences of a prefill) are no
+    references and are left out, they would not fit the columns.
+    '''
+    pairs = []
+    seen = set()
+    for feature_name, value in (unit.features or {}).items():
+        if not isinstance(value, list):
+            continue
+        for item in value:
+            if not isinstance(item, str) or not normalize_name(item) or len(item.strip()) > NAME_MAX_LENGTH:
+                continue
+            if (feature_name, normalize_name(item)) not in seen:
+                seen.add((feature_name, normalize_name(item)))
+                pairs.append((feature_name, item.strip()))
+    return pairs
+
+
+def resolve_unit_names(connection, story_id, normalized_names):
+    '''
+    Map normalized names to the ids of the units of the story that have them.
+    '''
+    unit_table = Unit.__table__
+    normalized_names = list(normalized_names)
+    ids = {}
+    for start in range(0, len(normalized_names), 500):
+        chunk = normalized_names[start:start + 500]
+        ids.update(connection.execute(
+            db.select(unit_table.c.normalized_name, unit_table.c.id).where(
+                unit_table.c.story_id == story_id,
+                unit_table.c.normalized_name.in_(chunk)
+            )
+        ).all())
+    return ids
+
+
+def replace_unit_references(connection, unit):
+    '''
+    Write the unit_reference rows of unit from scratch.
+    '''
+    table = UnitReference.__table__
+    connection.execute(table.delete().where(table.c.source_unit_id == unit.id))
+    pairs = unit_reference_names(unit)
+    if not pairs:
+        return
+    unit_ids = resolve_unit_names(connection, unit.story_id, {normalize_name(name) for _, name in pairs})
+    connection.execute(table.insert(), [
+        {
+            'story_id': unit.story_id,
+            'source_unit_id': unit.id,
+            'feature': feature_name,
+            'target_name': name,
+            'target_normalized': normalize_name(name),
+            'target_unit_id': unit_ids.get(normalize_name(name)),
+        }
+        for feature_name, name in pairs
+    ])
+
+
+def retarget_unit_references(connection, unit):
+    '''
+    Point the references to unit's current name at it, and unresolve the
+    ones that pointed at it under a name it no longer has.
+    '''
+    table = UnitReference.__table__
+    connection.execute(
+        table.update()
+        .where(table.c.target_unit_id == unit.id, table.c.target_normalized != (unit.normalized_name or ''))
+        .values(target_unit_id=None)
+    )
+    if unit.normalized_name:
+        connection.execute(
+            table.update()
+            .where(table.c.story_id == unit.story_id, table.c.target_normalized == unit.normalized_name)
+            .values(target_unit_id=unit.id)
+        )
+
+
+def update_unit_references(connection, unit):
+    '''
+    Bring the unit_reference rows of an existing unit in line with its
+    features, touching only the names that were added, removed or respelled.
+    '''
+    table = UnitReference.__table__
+    existing = {
+        (row.feature, row.target_normalized): (row.id, row.target_name)
+        for row in connection.execute(
+            db.select(table.c.id, table.c.feature, table.c.target_normalized, table.c.target_name)
+            .where(table.c.source_unit_id == unit.id)
+        )
+    }
+    wanted = {(feature_name, normalize_name(name)): name for feature_name, name in unit_reference_names(unit)}
+
+    removed = [row_id for key, (row_id, _) in existing.items() if key not in wanted]
+    for start in range(0, len(removed), 500):
+        connection.execute(table.delete().where(table.c.id.in_(removed[start:start + 500])))
+    for key, name in wanted.items():
+        if key in existing and existing[key][1] != name:
+            connection.execute(table.update().where(table.c.id == existing[key][0]).values(target_name=name))
+
+    added = [(key[0], name) for key, name in wanted.items() if key not in existing]
+    if not added:
+        return
+    unit_ids = resolve_unit_names(connection, unit.story_id, {normalize_name(name) for _, name in added})
+    connection.execute(table.insert(), [
+        {
+            'story_id': unit.story_id,
+            'source_unit_id': unit.id,
+            'feature': feature_name,
+            'target_name': name,
+            'target_normalized': normalize_name(name),
+            'target_unit_id': unit_ids.get(normalize_name(name)),
+        }
+        for feature_name, name in added
+    ])
+
+
+@event.listens_for(Session, 'after_flush')
+def sync_unit_references(session, flush_context):
+    '''
+    Keep unit_reference in step with the units written in this flush. Runs
+    after the flush so that new units have their ids and all names are in
+    the unit table. Only the rows of the changed units and the references
+    to renamed units are touched, so a save costs the same in any story size.
+    '''
+    new = [obj for obj in session.new if isinstance(obj, Unit)]
+    changed = [obj for obj in session.dirty if isinstance(obj, Unit) and session.is_modified(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Unit)]
+    if not new and not changed and not deleted:
+        return
+
+    connection = session.connection()
+    table = UnitReference.__table__
+    for unit in deleted:
+        connection.execute(table.delete().where(table.c.source_unit_id == unit.id))
+        connection.execute(table.update().where(table.c.target_unit_id == unit.id).values(target_unit_id=None))
+    for unit in new:
+        replace_unit_references(connection, unit)
+    for unit in changed:
+        update_unit_references(connection, unit)
+    # History still shows the state before the flush here
+    for unit in new + [unit for unit in changed if inspect(unit).attrs.normalized_name.history.has_changes()]:
+        retarget_unit_references(connection, unit)
+
+
+def rebuild_unit_references(story):
+    '''
+    Recreate all unit_reference rows of story from the units' features.
+    '''
+    db.session.flush()
+    connection = db.session.connection()
+    for unit in story.units:
+        replace_unit_references(connection, unit)
+
+
 # Subclasses of Unit
 
 # Subclasses of Unit
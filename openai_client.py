@@ -1,7 +1,109 @@
-import openai
+import os
+import random
+import threading
 import time
 
-client = openai.OpenAI()
+import httpx
+import openai
+
+from llm_cache import llm_cache, make_cache_key, LLM_CACHE_ENABLED
+from llm_errors import LLMError, LLMTimeoutError, LLMRateLimitError, LLMUnavailableError, LLMRequestError, LLMBusyError
+from llm_metrics import llm_metrics
+from rate_limit import llm_limiter
+from singleflight import SingleFlight
+
+# Point this at fake_openai_server.py (e.g. http://localhost:8001/v1) to run without the real API
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL') or None
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', 60))  # Seconds per attempt
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', 5))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 3))
+OPENAI_BACKOFF_BASE = float(os.environ.get('OPENAI_BACKOFF_BASE', 0.5))
+OPENAI_BACKOFF_MAX = float(os.environ.get('OPENAI_BACKOFF_MAX', 8))
+OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS', 20))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('OPENAI_MAX_KEEPALIVE_CONNECTIONS', 10))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', 30))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+llm_singleflight = SingleFlight(llm_cache)
+
+
+def get_client():
+    '''
+    Return the shared OpenAI client. It keeps a pool of keep-alive connections,
+    so consecutive calls reuse their TCP/TLS connection.
+    '''
+    global _client
+    with _client_lock:
+        if _client is None:
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+            )
+            # Retries are done by create_completion, so they can be jittered and counted
+            _client = openai.OpenAI(base_url=OPENAI_BASE_URL, http_client=http_client, max_retries=0)
+        return _client
+
+
+def _backoff_delay(attempt, retry_after=None):
+    # Exponential backoff with full jitter, but never sooner than the server asked for
+    delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+    if retry_after:
+        delay = max(delay, min(retry_after, OPENAI_BACKOFF_MAX))
+    return delay
+
+
+def _retry_after(e):
+    try:
+        return float(e.response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def create_completion(timeout=None, max_retries=OPENAI_MAX_RETRIES, call_stats=None, **kwargs):
+    '''
+    Call chat.completions.create on the shared client. Timeouts, rate limits,
+    connection problems and 5xx answers are retried with backoff, everything
+    is raised as an LLMError subclass. The number of retries is written to
+    call_stats['retries'] if a dict is given.
+    '''
+    timeout = timeout or OPENAI_TIMEOUT
+    for attempt in range(max_retries + 1):
+        if call_stats is not None:
+            call_stats['retries'] = attempt
+        retry_after = None
+        try:
+            return get_client().chat.completions.create(
+                timeout=httpx.Timeout(timeout, connect=OPENAI_CONNECT_TIMEOUT),
+                **kwargs
+            )
+        except openai.APITimeoutError as e:
+            cause = e
+            error = LLMTimeoutError("The language model took too long to answer. Please try again.")
+        except openai.APIConnectionError as e:
+            cause = e
+            error = LLMUnavailableError("The language model could not be reached. Please try again later.")
+        except openai.RateLimitError as e:
+            cause = e
+            retry_after = _retry_after(e)
+            error = LLMRateLimitError("The language model is busy right now. Please try again in a moment.")
+        except openai.APIStatusError as e:
+            if e.status_code < 500:
+                raise LLMRequestError(f"The language model rejected the request: {e.message}") from e
+            cause = e
+            error = LLMUnavailableError("The language model is unavailable right now. Please try again later.")
+
+        if attempt == max_retries:
+            raise error from cause
+        delay = _backoff_delay(attempt, retry_after)
+        print(f'API request failed ({cause.__class__.__name__}), retrying in {delay:.1f}s')
+        time.sleep(delay)
 
 '''
 def call_openai(story, unit_type, description, feature_schema):
@@ -30,17 +132,150 @@ def call_openai(story, unit_type, description, feature_schema):
         return errors, None
 '''
 
-def call_openai(messages, model="gpt-4o-mini"):
+def call_openai(messages, model="gpt-4o-mini", use_cache=True, stream=False, timeout=None, route='other',
+                user_id=None, response_format=None):
+    '''
+    Send messages to the chat completions API and return the reply text.
+    Identical requests are answered from the LLM cache unless use_cache is False;
+    a bypassed call still stores its fresh reply for later callers.
+    With stream=True a generator is returned that yields the reply piece by piece.
+    Failures are raised as LLMError subclasses.
+    route names the caller (prefill, board_game, full_story, ...) in the LLM metrics.
+    Calls that reach the API go through the limiter under user_id and raise
+    LLMBusyError when the user is out of quota or no slot frees up in time.
+    response_format is passed on to the API (e.g. a JSON schema for structured output).
+    '''
     t = time.time()
-    response = openai.chat.completions.create(
-        model=model,
-        messages=messages
+    cache_key = make_cache_key(model, messages, response_format=response_format)
+    cached_reply = None
+    if use_cache and LLM_CACHE_ENABLED:
+        cached_reply = llm_cache.get(cache_key)
+
+    if stream:
+        return _stream_openai(messages, model, cache_key, cached_reply, timeout, route, t, user_id)
+    if cached_reply is not None:
+        llm_metrics.record_call(route, model, time.time() - t, cache_hit=True)
+        return cached_reply
+
+    # Identical calls that are already running are joined instead of sent again
+    assistant_reply, shared = llm_singleflight.do(
+        cache_key,
+        lambda: _complete(messages, model, cache_key, timeout, route, user_id, t, response_format),
+        across_processes=use_cache and LLM_CACHE_ENABLED
     )
-    print(f'API request took {time.time() - t}')
+    if shared:
+        llm_metrics.inc('llm_coalesced_total', route=route, model=model)
+    return assistant_reply
+
+
+def _complete(messages, model, cache_key, timeout, route, user_id, t, response_format=None):
+    call_stats = {}
+    extra = {'response_format': response_format} if response_format else {}
+    try:
+        with llm_limiter.slot(user_id, estimate_prompt_tokens(messages)) as slot_usage:
+            response = create_completion(
+                model=model,
+                messages=messages,
+                timeout=timeout,
+                call_stats=call_stats,
+                **extra
+            )
+            if response.usage:
+                slot_usage['tokens'] = response.usage.completion_tokens
+    except LLMError as e:
+        llm_metrics.record_call(route, model, time.time() - t, retries=call_stats.get('retries', 0),
+                                error=e.__class__.__name__)
+        raise
+    latency = time.time() - t
+    usage = response.usage
+    llm_metrics.record_call(
+        route, model, latency,
+        prompt_tokens=usage.prompt_tokens if usage else 0,
+        completion_tokens=usage.completion_tokens if usage else 0,
+        retries=call_stats.get('retries', 0)
+    )
+    print(f'API request ({route}, {model}) took {latency:.2f}s')
 
     # Parse the assistant's reply
-    assistant_reply = response.choices[0].message.content
+    message = response.choices[0].message
+    assistant_reply = message.content
+    if assistant_reply is None:
+        # A refusal under a strict json_schema, or a reply with only a tool call; nothing is cached
+        refusal = getattr(message, 'refusal', None)
+        raise LLMRequestError(f"The language model refused to answer: {refusal}" if refusal
+                              else "The language model returned an empty reply. Please try again.")
     if assistant_reply.startswith('```json') and assistant_reply.endswith('```'):
         assistant_reply = assistant_reply[8:-4]
 
+    if LLM_CACHE_ENABLED:
+        llm_cache.set(cache_key, assistant_reply)
+
     return assistant_reply
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text, the real count is only known afterwards.
+    # The one estimate for context budgets, the limiter and the fake server, so they agree
+    return len(text) // 4 + 1
+
+
+def estimate_prompt_tokens(messages):
+    return estimate_tokens(''.join(str(message.get('content') or '') for message in messages))
+
+
+def _stream_openai(messages, model, cache_key, cached_reply, timeout, route, t, user_id):
+    if cached_reply is not None:
+        llm_metrics.record_call(route, model, time.time() - t, cache_hit=True)
+        yield cached_reply
+        return
+
+    call_stats = {}
+    usage = None
+    parts = []
+    try:
+        # The slot is held until the whole reply has been streamed
+        with llm_limiter.slot(user_id, estimate_prompt_tokens(messages)) as slot_usage:
+            response = create_completion(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True},
+                timeout=timeout,
+                call_stats=call_stats
+            )
+            try:
+                for chunk in response:
+                    if chunk.usage:
+                        usage = chunk.usage
+                        slot_usage['tokens'] = usage.completion_tokens
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not parts:
+                            llm_metrics.observe_first_token(route, model, time.time() - t)
+                        parts.append(delta)
+                        yield delta
+            except (httpx.TimeoutException, openai.APITimeoutError) as e:
+                raise LLMTimeoutError("The language model stopped answering. Please try again.") from e
+            except (httpx.HTTPError, openai.APIError) as e:
+                raise LLMUnavailableError("The connection to the language model was lost. Please try again.") from e
+            finally:
+                response.close()
+    except LLMError as e:
+        llm_metrics.record_call(route, model, time.time() - t, retries=call_stats.get('retries', 0),
+                                error=e.__class__.__name__)
+        raise
+
+    latency = time.time() - t
+    llm_metrics.record_call(
+        route, model, latency,
+        prompt_tokens=usage.prompt_tokens if usage else 0,
+        completion_tokens=usage.completion_tokens if usage else 0,
+        retries=call_stats.get('retries', 0)
+    )
+    print(f'API request ({route}, {model}, streamed) took {latency:.2f}s')
+
+    # Only a completely received reply is worth caching
+    if LLM_CACHE_ENABLED:
+        llm_cache.set(cache_key, ''.join(parts))
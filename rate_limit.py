@@ -0,0 +1,166 @@
+# rate_limit.py
+'''
+Admission control in front of the LLM. The limiter lives in each worker
+process, the settings below are the budget of the whole app: every process
+gets an equal share of it (LLM_WORKER_PROCESSES, by default gunicorn's
+WEB_CONCURRENCY). All processes together therefore stay within the limits
+(except that each process allows at least one concurrent call); a user
+whose calls all land in one process gets only that process's share.
+'''
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from llm_errors import LLMBusyError
+
+# For all worker processes together, each process enforces its share
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 8))
+LLM_USER_REQUESTS_PER_MINUTE = float(os.environ.get('LLM_USER_REQUESTS_PER_MINUTE', 20))
+LLM_USER_TOKENS_PER_MINUTE = float(os.environ.get('LLM_USER_TOKENS_PER_MINUTE', 200000))
+# Number of processes the limits are divided among, gunicorn starts WEB_CONCURRENCY workers by default
+LLM_WORKER_PROCESSES = max(1, int(os.environ.get('LLM_WORKER_PROCESSES') or os.environ.get('WEB_CONCURRENCY') or 1))
+LLM_QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT', 60))  # Seconds to wait for a free slot
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0  # Refill per second
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        '''
+        Seconds until amount can be taken (0 if it can be taken right away).
+        '''
+        self._refill()
+        # Requests bigger than the whole bucket only have to wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= amount  # May go negative, later requests then pay off the debt
+
+
+class _Ticket:
+    def __init__(self, user_key):
+        self.user_key = user_key
+        self.granted = False
+
+
+class LLMLimiter:
+    '''
+    Admission control in front of the LLM: a global cap on concurrent calls,
+    a request and a token bucket per user, and round-robin queueing across
+    users so that one user with many pending calls cannot starve the others.
+    The limits are shared by processes, this process enforces its share.
+    '''
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, requests_per_minute=LLM_USER_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=LLM_USER_TOKENS_PER_MINUTE, queue_timeout=LLM_QUEUE_TIMEOUT,
+                 processes=LLM_WORKER_PROCESSES):
+        self.max_concurrency = max(1, max_concurrency // processes)
+        self.requests_per_minute = requests_per_minute / processes
+        self.tokens_per_minute = tokens_per_minute / processes
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._queues = {}  # user key -> deque of waiting tickets
+        self._turns = deque()  # user keys with waiting tickets, in round-robin order
+        self._buckets = {}  # user key -> (request bucket, token bucket)
+
+    def _user_buckets(self, user_key):
+        if user_key not in self._buckets:
+            self._buckets[user_key] = (TokenBucket(self.requests_per_minute), TokenBucket(self.tokens_per_minute))
+        return self._buckets[user_key]
+
+    def _quota_wait(self, user_key, tokens):
+        request_bucket, token_bucket = self._user_buckets(user_key)
+        return max(request_bucket.wait_time(1), token_bucket.wait_time(tokens))
+
+    def check(self, user_id, tokens=0):
+        '''
+        Raise LLMBusyError if the user is out of quota, without using any of it.
+        '''
+        with self._cond:
+            wait = self._quota_wait(user_id or 'anonymous', tokens)
+        if wait:
+            raise LLMBusyError(wait)
+
+    def _dispatch(self):
+        # Caller holds self._cond
+        while self._active < self.max_concurrency and self._turns:
+            user_key = self._turns.popleft()
+            queue = self._queues[user_key]
+            ticket = queue.popleft()
+            ticket.granted = True
+            self._active += 1
+            if queue:
+                self._turns.append(user_key)
+            else:
+                del self._queues[user_key]
+        self._cond.notify_all()
+
+    def acquire(self, user_id, tokens):
+        user_key = user_id or 'anonymous'
+        with self._cond:
+            wait = self._quota_wait(user_key, tokens)
+            if wait:
+                raise LLMBusyError(wait)
+            request_bucket, token_bucket = self._user_buckets(user_key)
+            request_bucket.take(1)
+            token_bucket.take(tokens)
+
+            ticket = _Ticket(user_key)
+            if user_key not in self._queues:
+                self._queues[user_key] = deque()
+                self._turns.append(user_key)
+            self._queues[user_key].append(ticket)
+            self._dispatch()
+
+            deadline = time.monotonic() + self.queue_timeout
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Give the quota back, the call never happened
+                    request_bucket.take(-1)
+                    token_bucket.take(-tokens)
+                    self._queues[user_key].remove(ticket)
+                    if not self._queues[user_key]:
+                        del self._queues[user_key]
+                        self._turns.remove(user_key)
+                    raise LLMBusyError(self.queue_timeout / 2)
+                self._cond.wait(remaining)
+
+    def release(self, user_id, used_tokens=0):
+        '''
+        Free the slot again. used_tokens (e.g. the completion tokens, which are
+        unknown up front) are charged to the user's token bucket.
+        '''
+        with self._cond:
+            self._active -= 1
+            if used_tokens:
+                self._user_buckets(user_id or 'anonymous')[1].take(used_tokens)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, user_id, tokens):
+        self.acquire(user_id, tokens)
+        usage = {'tokens': 0}
+        try:
+            yield usage
+        finally:
+            self.release(user_id, usage['tokens'])
+
+
+llm_limiter = LLMLimiter()
@@ -0,0 +1,112 @@
+# singleflight.py
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# How long a process may hold the cross-process lock before others take over
+SINGLEFLIGHT_LOCK_TTL = float(os.environ.get('SINGLEFLIGHT_LOCK_TTL', 300))
+SINGLEFLIGHT_POLL_INTERVAL = float(os.environ.get('SINGLEFLIGHT_POLL_INTERVAL', 0.25))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Coalesce identical concurrent calls: the first caller for a key runs the
+    function, everybody else who asks for the same key meanwhile waits for and
+    shares its result (or its exception).
+
+    Within a process this uses an event per key. With a cache (llm_cache) the
+    callers in other worker processes are coalesced as well: a row in the
+    cache database's llm_inflight table marks the key as in flight, and the
+    other processes wait for the result to show up in the cache.
+    '''
+
+    def __init__(self, cache=None, lock_ttl=SINGLEFLIGHT_LOCK_TTL, poll_interval=SINGLEFLIGHT_POLL_INTERVAL):
+        self.cache = cache
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Call
+
+    def do(self, key, func, across_processes=True):
+        '''
+        Return (result, shared) where shared tells whether the result came from
+        somebody else's call. Pass across_processes=False when an answer that
+        is already in the cache must not be used.
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            if across_processes and self.cache is not None:
+                call.result, shared = self._do_across_processes(key, func)
+            else:
+                call.result, shared = func(), False
+            return call.result, shared
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _do_across_processes(self, key, func):
+        deadline = time.time() + self.lock_ttl
+        while True:
+            try:
+                locked = self.cache.try_lock(key, self.owner, self.lock_ttl)
+            except sqlite3.Error as e:
+                print(f"Single flight lock failed, calling without it: {e}")
+                return func(), False
+
+            if locked:
+                try:
+                    # Somebody may have finished between our cache miss and taking the lock
+                    result = self.cache.get(key, count=False)
+                    if result is not None:
+                        return result, True
+                    return func(), False
+                finally:
+                    self._unlock(key)
+
+            # Another process is on it, wait for its result to land in the cache
+            while time.time() < deadline:
+                time.sleep(self.poll_interval)
+                result = self.cache.get(key, count=False)
+                if result is not None:
+                    return result, True
+                try:
+                    locked = self.cache.is_locked(key)
+                except sqlite3.Error as e:
+                    print(f"Single flight lock check failed, calling without it: {e}")
+                    return func(), False
+                if not locked:
+                    break  # The other process gave up (error or crash), try ourselves
+            if time.time() >= deadline:
+                return func(), False
+
+    def _unlock(self, key):
+        # A failed unlock must not fail a call that succeeded, the row expires after lock_ttl
+        try:
+            self.cache.unlock(key, self.owner)
+        except sqlite3.Error as e:
+            print(f"Single flight unlock failed, the lock expires by itself: {e}")
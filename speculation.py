@@ -0,0 +1,55 @@
+# speculation.py
+import os
+import threading
+import time
+
+# Start a prefill as soon as the add unit form is opened, see add_unit in app.py
+SPECULATIVE_PREFILL = os.environ.get('SPECULATIVE_PREFILL', '0') == '1'
+SPECULATIVE_PREFILL_TTL = float(os.environ.get('SPECULATIVE_PREFILL_TTL', 300))  # Seconds
+SPECULATIVE_PREFILL_PER_USER = int(os.environ.get('SPECULATIVE_PREFILL_PER_USER', 4))
+
+
+class SpeculationCache:
+    '''
+    Short-lived per-user registry of speculatively started jobs. Maps a key
+    (e.g. story, unit type and name) to the id of the job that computes the
+    result. Entries expire after ttl seconds and every user keeps only the
+    newest max_per_user ones. The jobs themselves live in the job table, so
+    a worker process that does not know an entry just does the work again.
+    '''
+
+    def __init__(self, ttl=SPECULATIVE_PREFILL_TTL, max_per_user=SPECULATIVE_PREFILL_PER_USER):
+        self.ttl = ttl
+        self.max_per_user = max_per_user
+        self._lock = threading.Lock()
+        self._entries = {}  # user id -> {key: (job id, expires at)}
+
+    def _user_entries(self, user_id):
+        # Caller holds self._lock
+        now = time.time()
+        entries = self._entries.get(user_id, {})
+        for key in [key for key, (_, expires_at) in entries.items() if expires_at < now]:
+            del entries[key]
+        return entries
+
+    def get(self, user_id, key):
+        with self._lock:
+            entry = self._user_entries(user_id).get(key)
+            return entry[0] if entry else None
+
+    def put(self, user_id, key, job_id):
+        with self._lock:
+            entries = self._user_entries(user_id)
+            entries.pop(key, None)
+            entries[key] = (job_id, time.time() + self.ttl)
+            while len(entries) > self.max_per_user:
+                del entries[next(iter(entries))]  # Dicts keep insertion order, drop the oldest
+            self._entries[user_id] = entries
+
+    def pop(self, user_id, key):
+        with self._lock:
+            entry = self._user_entries(user_id).pop(key, None)
+            return entry[0] if entry else None
+
+
+speculations = SpeculationCache()
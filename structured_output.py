@@ -0,0 +1,190 @@
+# structured_output.py
+import json
+import re
+
+from llm_metrics import llm_metrics
+from openai_client import call_openai
+
+TRUE_WORDS = {'true', 'yes', 'y', '1', 'on', 'checked'}
+FALSE_WORDS = {'false', 'no', 'n', '0', 'off', 'none', ''}
+
+
+def json_schema_response_format(name, schema):
+    '''
+    response_format for call_openai that makes the model answer with JSON matching schema.
+    '''
+    return {
+        'type': 'json_schema',
+        'json_schema': {'name': re.sub(r'[^a-zA-Z0-9_-]', '_', name), 'strict': True, 'schema': schema},
+    }
+
+
+JSON_OBJECT_RESPONSE_FORMAT = {'type': 'json_object'}
+
+
+def _repair_json(text):
+    '''
+    Fix the usual ways in which a model's JSON is broken: code fences and chatter
+    around it, single quotes, Python literals, trailing commas and a reply that
+    was cut off before all strings and brackets were closed.
+    '''
+    text = text.strip()
+    text = re.sub(r'^```[a-zA-Z]*\s*', '', text)
+    text = re.sub(r'\s*```$', '', text)
+    text = text.translate({0x201c: '"', 0x201d: '"', 0x2018: "'", 0x2019: "'"})
+    starts = [i for i in (text.find('{'), text.find('[')) if i != -1]
+    if not starts:
+        raise ValueError("No JSON object found in the reply.")
+    text = text[min(starts):]
+
+    out = []
+    stack = []
+    quote = None  # The quote character of the string we are in
+    i = 0
+
+    def drop_trailing_comma():
+        while out and out[-1].isspace():
+            out.pop()
+        if out and out[-1] == ',':
+            out.pop()
+
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == '\\' and i + 1 < len(text):
+                escaped = text[i + 1]
+                out.append("'" if quote == "'" and escaped == "'" else char + escaped)
+                i += 2
+                continue
+            if char == quote:
+                out.append('"')
+                quote = None
+            elif char == '"':
+                out.append('\\"')  # A double quote inside a single-quoted string
+            elif char == '\n':
+                out.append('\\n')
+            else:
+                out.append(char)
+        elif char in '"\'':
+            quote = char
+            out.append('"')
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+            out.append(char)
+        elif char in '}]':
+            drop_trailing_comma()
+            if stack:
+                out.append(stack.pop())
+            if not stack:
+                break  # Anything after the outermost value is chatter
+        elif char.isalpha():
+            # \w also matches every non-ASCII letter that isalpha() accepts
+            word = re.match(r'\w+', text[i:]).group(0)
+            out.append({'True': 'true', 'False': 'false', 'None': 'null'}.get(word, word))
+            i += len(word)
+            continue
+        else:
+            out.append(char)
+        i += 1
+
+    if quote:
+        out.append('"')
+    drop_trailing_comma()
+    if out and out[-1] == ':':
+        out.append('null')
+    while stack:
+        out.append(stack.pop())
+    return ''.join(out)
+
+
+def parse_json_reply(text):
+    '''
+    Parse a JSON reply of the model, repairing it locally if needed.
+    Returns (data, repaired) and raises ValueError if nothing can be made of it.
+    '''
+    try:
+        return json.loads(text), False
+    except (TypeError, ValueError):
+        pass
+    try:
+        return json.loads(_repair_json(text or '')), True
+    except ValueError as e:
+        raise ValueError(f"The reply could not be read as JSON: {e}")
+
+
+def coerce_value(value, expected_type):
+    '''
+    Convert value to expected_type where that is unambiguous. Returns (value, ok).
+    '''
+    if expected_type == bool:
+        if isinstance(value, bool):
+            return value, True
+        if isinstance(value, (int, float)):
+            return bool(value), True
+        if isinstance(value, str) and value.strip().lower() in TRUE_WORDS | FALSE_WORDS:
+            return value.strip().lower() in TRUE_WORDS, True
+        return False, value is None
+
+    if expected_type == float:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            number = float(value)
+        elif isinstance(value, str):
+            text = value.strip()
+            try:
+                number = float(text.rstrip('%')) / (100 if text.endswith('%') else 1)
+            except ValueError:
+                return 0.0, False
+        else:
+            return 0.0, value is None
+        # The form only knows values from 0.0 to 1.0
+        return min(1.0, max(0.0, number)), True
+
+    if expected_type == list:
+        if value is None:
+            return [], True
+        if isinstance(value, str):
+            items = re.split(r'[,;\n]', value)
+        elif isinstance(value, list):
+            items = value
+        else:
+            items = [value]
+        return [str(item).strip() for item in items if item is not None and str(item).strip()], True
+
+    if expected_type == int:
+        try:
+            return int(value), True
+        except (TypeError, ValueError):
+            return 1, False
+
+    if value is None:
+        return '', True
+    if isinstance(value, list):
+        return ', '.join(str(item) for item in value), True
+    return str(value).strip(), True
+
+
+def call_openai_json(messages, route='other', user_id=None, response_format=JSON_OBJECT_RESPONSE_FORMAT, **kwargs):
+    '''
+    call_openai for replies that must be JSON, returns the parsed data.
+    Broken JSON is repaired locally; only if that is impossible the model is
+    asked once more, bypassing the cache entry with the broken reply. Raises
+    ValueError if the second reply cannot be read either.
+    Every reply is counted in llm_json_replies_total (outcome valid, repaired
+    or unreadable) and every second call in llm_json_retries_total.
+    '''
+    reply = call_openai(messages, route=route, user_id=user_id, response_format=response_format, **kwargs)
+    try:
+        data, repaired = parse_json_reply(reply)
+    except ValueError as e:
+        llm_metrics.inc('llm_json_replies_total', route=route, outcome='unreadable')
+        llm_metrics.inc('llm_json_retries_total', route=route)
+        print(f"Unreadable JSON reply ({route}), asking again: {e}")
+        kwargs['use_cache'] = False
+        reply = call_openai(messages, route=route, user_id=user_id, response_format=response_format, **kwargs)
+        try:
+            data, repaired = parse_json_reply(reply)
+        except ValueError:
+            llm_metrics.inc('llm_json_replies_total', route=route, outcome='unreadable')
+            raise ValueError("The language model did not answer with valid JSON. Please try again.")
+    llm_metrics.inc('llm_json_replies_total', route=route, outcome='repaired' if repaired else 'valid')
+    return data
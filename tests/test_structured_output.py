@@ -0,0 +1,42 @@
+import unittest
+
+from structured_output import parse_json_reply
+
+
+class ParseJsonReplyTest(unittest.TestCase):
+
+    def test_valid_json_is_not_repaired(self):
+        self.assertEqual(parse_json_reply('{"name": "Zoë"}'), ({'name': 'Zoë'}, False))
+
+    def test_trailing_commas(self):
+        self.assertEqual(parse_json_reply('{"a": [1, 2,], }'), ({'a': [1, 2]}, True))
+
+    def test_single_quotes(self):
+        self.assertEqual(parse_json_reply("{'a': 'it\\'s \"x\"'}"), ({'a': 'it\'s "x"'}, True))
+
+    def test_python_literals(self):
+        data, repaired = parse_json_reply('{"a": True, "b": None, "c": False}')
+        self.assertEqual(data, {'a': True, 'b': None, 'c': False})
+        self.assertTrue(repaired)
+
+    def test_code_fence_and_chatter(self):
+        self.assertEqual(parse_json_reply('Here you go:\n```json\n{"a": 1}\n```\nDone.'), ({'a': 1}, True))
+
+    def test_truncated_object(self):
+        self.assertEqual(parse_json_reply('{"a": "Ärger", "b": ["x", "y'), ({'a': 'Ärger', 'b': ['x', 'y']}, True))
+        self.assertEqual(parse_json_reply('{"a":'), ({'a': None}, True))
+
+    def test_bare_words_raise_value_error(self):
+        # Words that are no JSON literal cannot be repaired, the caller asks the model again
+        for text in ('{"a": unknown}', '{"a": Ärger}', '{"a": Ωmega_1}'):
+            with self.assertRaises(ValueError):
+                parse_json_reply(text)
+
+    def test_no_json(self):
+        for text in ('no json here', '', None):
+            with self.assertRaises(ValueError):
+                parse_json_reply(text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+# unit_schema.py
+'''
+The feature_schema of every Unit subclass, compiled once at import time into
+field descriptors. The form, the validation of submitted and generated
+features and the prompts all read these instead of walking feature_schema
+and comparing types on every request.
+'''
+import re
+
+from models import NAME_MAX_LENGTH, Unit, normalize_name
+from structured_output import coerce_value, json_schema_response_format
+
+JSON_TYPES = {bool: 'boolean', float: 'number', str: 'string', list: 'array', int: 'integer'}
+
+# Input element of add_unit.html for each type, 'unknown' shows a plain text input
+WIDGETS = {bool: 'bool', float: 'float', str: 'str', list: 'list', int: 'int'}
+
+
+def _key(name):
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+
+def _form_value(form_data, name):
+    return form_data.get(name, [''])[0]
+
+
+def _coerce_bool(field, form_data, units_by_name):
+    return _form_value(form_data, field.name) == 'on', None
+
+
+def _coerce_float(field, form_data, units_by_name):
+    value = _form_value(form_data, field.name)
+    try:
+        return float(value) if value else 0.0, None
+    except ValueError:
+        return 0.0, f"Invalid value for {field.name}."
+
+
+def _coerce_str(field, form_data, units_by_name):
+    value = _form_value(form_data, field.name)
+    return value.strip() if value else '', None
+
+
+def _coerce_int(field, form_data, units_by_name):
+    value = _form_value(form_data, field.name)
+    try:
+        return int(value) if value else 1, None
+    except ValueError:
+        return 1, f"Invalid value for {field.name}."
+
+
+def _coerce_list(field, form_data, units_by_name):
+    values = []
+    for value in field.submitted_names(form_data):
+        # Names of existing units are written the way the unit spells them
+        related_unit = units_by_name.get(normalize_name(value))
+        values.append(related_unit.name if related_unit else value.strip())
+    return values, None
+
+
+def _coerce_unknown(field, form_data, units_by_name):
+    return _form_value(form_data, field.name), f"Unsupported type for {field.name}."
+
+
+FORM_COERCERS = {bool: _coerce_bool, float: _coerce_float, str: _coerce_str, list: _coerce_list, int: _coerce_int}
+
+
+class FieldSpec:
+    '''
+    One feature of a unit type: its type, the form widget, how submitted and
+    generated values are converted, its JSON schema and its prompt lines.
+    '''
+
+    def __init__(self, name, expected_type):
+        self.name = name
+        self.type = expected_type
+        self.type_name = expected_type.__name__ if not isinstance(expected_type, tuple) else 'list'
+        self.widget = WIDGETS.get(expected_type, 'unknown')
+        self.is_list = expected_type == list
+        self.key = _key(name)
+        self._coerce_form = FORM_COERCERS.get(expected_type, _coerce_unknown)
+
+        # Sent as response_format, which is part of the LLM cache key: changing the
+        # schema of a field makes every cached prefill of the unit type a miss
+        self.json_schema = {'type': JSON_TYPES[expected_type]} if expected_type in JSON_TYPES else {}
+        if self.is_list:
+            self.json_schema['items'] = {'type': 'string'}
+        # The prompt lines are written as they were before the schemas were compiled
+        self.prompt_line = f"- '{name}' ({self.type_name}): {expected_type}\n"
+        self.short_prompt_line = f"- '{name}' ({self.type_name})\n"
+
+    def submitted_names(self, form_data):
+        '''
+        The names selected in and typed into the form for a list feature.
+        '''
+        # Checked names and one text input per name, plus the older comma-separated _new input
+        selected_values = form_data.get(self.name) or []
+        new_values = form_data.get(self.name + '_new', [''])[0].split(', ')
+        # Inputs that were left empty
+        return [value for value in selected_values + new_values if value.strip()]
+
+    def from_form(self, form_data, units_by_name):
+        '''
+        The value of this feature in the submitted form, returns (value, error).
+        '''
+        return self._coerce_form(self, form_data, units_by_name)
+
+    def from_generated(self, value):
+        '''
+        The value of this feature in a model's reply, returns (value, ok).
+        '''
+        return coerce_value(value, self.type)
+
+    def empty_value(self):
+        return self.type()
+
+
+class UnitSchema:
+    '''
+    The compiled feature_schema of a Unit subclass.
+    '''
+
+    def __init__(self, unit_class):
+        self.unit_class = unit_class
+        self.unit_type = unit_class.__name__
+        self.fields = [FieldSpec(name, expected_type) for name, expected_type in unit_class.feature_schema.items()]
+        self.by_name = {field.name: field for field in self.fields}
+        self.list_fields = [field for field in self.fields if field.is_list]
+        self.json_schema = {
+            'type': 'object',
+            'properties': {field.name: field.json_schema for field in self.fields},
+            'required': [field.name for field in self.fields],
+            'additionalProperties': False,
+        }
+        self.response_format = json_schema_response_format(self.unit_type, self.json_schema)
+        self.prompt_lines = ''.join(field.prompt_line for field in self.fields)
+        self.short_prompt_lines = ''.join(field.short_prompt_line for field in self.fields)
+
+    def submitted_names(self, form_data):
+        '''
+        Every name selected in or typed into the list features of the form.
+        '''
+        names = []
+        for field in self.list_fields:
+            names.extend(form_data.get(field.name) or [])
+            names.extend(form_data.get(field.name + '_new', [''])[0].split(', '))
+        return names
+
+    def coerce_generated(self, data):
+        '''
+        Match the keys of generated features to the fields (ignoring case and
+        punctuation) and convert the values to the expected types. Unknown keys
+        are dropped, missing ones set to an empty value. Returns (features, errors).
+        '''
+        if not isinstance(data, dict):
+            return {field.name: field.empty_value() for field in self.fields}, ["The reply is not a JSON object."]
+
+        by_key = {_key(key): value for key, value in data.items()}
+        features = {}
+        errors = []
+        for field in self.fields:
+            value = data[field.name] if field.name in data else by_key.get(field.key)
+            features[field.name], ok = field.from_generated(value)
+            if not ok:
+                errors.append(f"Invalid value for {field.name}.")
+            elif field.name == 'name' and not features[field.name]:
+                errors.append("Missing value for name.")
+            elif field.name == 'name' and len(features[field.name]) > NAME_MAX_LENGTH:
+                errors.append(f"The name must not be longer than {NAME_MAX_LENGTH} characters.")
+        return features, errors
+
+
+# All unit types by name; models.py defines every subclass, so the registry is complete here
+UNIT_CLASSES = {cls.__name__: cls for cls in Unit.__subclasses__()}
+UNIT_SCHEMAS = {unit_type: UnitSchema(unit_class) for unit_type, unit_class in UNIT_CLASSES.items()}